@@ -0,0 +1,83 @@
+# Copyright 2024 Matej Bölcskei, ETH Zurich.
+# Licensed under the General Public License, Version 3.0, see LICENSE for details.
+# SPDX-License-Identifier: GPL-3.0-only
+
+import os
+import glob
+import contextlib
+
+def parse_cpulist(cpulist: str):
+    cpus = set()
+    for part in cpulist.strip().split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.update(range(int(first), int(last) + 1))
+        elif part:
+            cpus.add(int(part))
+    return cpus
+
+def read_cpulist(path: str):
+    try:
+        with open(path, 'r') as cpulist_file:
+            return parse_cpulist(cpulist_file.read())
+    except OSError:
+        return None
+
+# The physical cores available to this process as sets of their SMT siblings,
+# ordered by NUMA node so that consecutive cores share a node
+def physical_cores():
+    available = os.sched_getaffinity(0)
+    nodes = {}
+    for node in glob.glob("/sys/devices/system/node/node[0-9]*"):
+        for cpu in read_cpulist(os.path.join(node, "cpulist")) or set():
+            nodes[cpu] = int(os.path.basename(node)[4:])
+
+    cores = []
+    for cpu in sorted(available):
+        siblings = read_cpulist(f"/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list") or {cpu}
+        core = frozenset(siblings & available)
+        if core not in cores:
+            cores.append(core)
+    return sorted(cores, key=lambda core: (nodes.get(min(core), 0), min(core)))
+
+# With placement, each campaign runs on a physical core of its own, including
+# its SMT siblings, and the pool workers, which run the builds, formal checks
+# and replays, share the cores that are left. The workers are given at least
+# worker_cores physical cores, by default half of them or what the campaigns
+# leave if that is more, and campaigns beyond the number of campaign cores wait
+# for one. Without any campaign core, campaigns run unpinned.
+class Placement:
+    def __init__(self, campaigns: int, worker_cores: int = None):
+        cores = physical_cores()
+        if worker_cores is None:
+            worker_cores = max(len(cores) - campaigns, (len(cores) + 1) // 2)
+        worker_cores = min(max(worker_cores, 1), len(cores))
+        self.slots = min(campaigns, len(cores) - worker_cores)
+        self.free = cores[:self.slots]
+        self.workers = set().union(*cores[self.slots:])
+
+    def acquire(self):
+        if not self.free:
+            return None
+        return self.free.pop(0)
+
+    def release(self, cpus):
+        self.free.append(cpus)
+
+    def pin_worker(self):
+        os.sched_setaffinity(0, self.workers)
+
+# Affinity is a property of the calling thread and inherited by the processes it
+# starts, so a process started within pinned starts on cpus from its first
+# instruction, as do all of its children.
+@contextlib.contextmanager
+def pinned(cpus):
+    if cpus is None:
+        yield
+        return
+    previous = os.sched_getaffinity(0)
+    os.sched_setaffinity(0, cpus)
+    try:
+        yield
+    finally:
+        os.sched_setaffinity(0, previous)
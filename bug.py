@@ -6,11 +6,19 @@ import os
 import subprocess
 import datetime
 import shutil
+import tempfile
 
 from host import Host
+from cache import version, executable
 import defines
+import process
 
 class Bug:
+    # outputs of the stages below, which are linked from the cache again when needed
+    DISCARDED = [
+        "host.rtlil", "host.v", "reference.rtlil", "miter.v", "miter.rtlil", "miter.log"
+    ]
+
     def __init__(self, host: Host, name: str, driver: bool):
         self.host = host
         self.name = name
@@ -18,53 +26,69 @@ class Bug:
         self.directory = os.path.join(host.driver_directory if driver else host.mux_directory, name)
 
     def prepare(self):
-        if not os.path.exists(os.path.join(self.directory, "host.rtlil")):
-            subprocess.run(
-                [defines.YOSYS_PATH, '-c', self.host.prepare_driver if self.driver else self.host.prepare_multiplexer],
-                check=True,
+        if self.driver:
+            inputs = [os.path.join(self.directory, "host_driver.rtlil"), os.path.join(self.directory, "reference_driver.rtlil"), self.host.prepare_driver]
+        else:
+            inputs = [os.path.join(self.directory, "host_amt.rtlil"), os.path.join(self.directory, "..", "reference.rtlil"), self.host.prepare_multiplexer]
+
+        self.host.cache.run(
+            "prepare",
+            [os.path.join(self.directory, "host.rtlil"), os.path.join(self.directory, "host.v"), os.path.join(self.directory, "reference.rtlil")],
+            lambda: process.yosys.run(
+                self.host.prepare_driver if self.driver else self.host.prepare_multiplexer,
                 cwd=self.directory,
                 stdout=subprocess.DEVNULL
-            )
+            ),
+            files=inputs,
+            texts=[version(defines.YOSYS_PATH, "-V")]
+        )
         return self
-    
+
     def create_miter(self):
         self.miter_log = os.path.join(self.directory, "miter.log")
         self.miter = os.path.join(self.directory, "miter.v")
-        if not os.path.exists(self.miter):
-            subprocess.run(
-                [defines.YOSYS_PATH, '-c', self.host.miter_script],
-                check=True,
+        self.host.cache.run(
+            "create_miter",
+            [self.miter, os.path.join(self.directory, "miter.rtlil"), self.miter_log],
+            lambda: process.yosys.run(
+                self.host.miter_script,
                 cwd=self.directory,
-                stdout=open(self.miter_log, 'w'),
-            )
+                stdout=open(self.miter_log, 'w')
+            ),
+            files=[os.path.join(self.directory, "host.rtlil"), os.path.join(self.directory, "reference.rtlil"), self.host.miter_script],
+            texts=[version(defines.YOSYS_PATH, "-V")]
+        )
         return self
 
     # cds_jasper jg run.tcl --- ~/encarsia/test_jasper/driver/30/miter.v v_miter.sva sequence.rst proof.vcd proof_optimized.vcd
     def verify(self):
         self.verify_log = os.path.join(self.directory, "verify.log")
         self.proof_path = os.path.join(self.directory, "proof.vcd")
-        if not os.path.exists(self.verify_log):
-            subprocess.run(
+        self.host.cache.run(
+            "verify",
+            [self.verify_log, self.proof_path, os.path.join(self.directory, "proof_optimized.vcd")],
+            lambda: process.run(
                 [defines.JASPER, "jg", "-no_gui", os.path.join(defines.JASPER_SRCS, self.host.name, "run.tcl"), "---", self.miter, os.path.join(defines.JASPER_SRCS, self.host.name, "v_miter.sva"), os.path.join(defines.JASPER_SRCS, self.host.name, "sequence.rst"), self.proof_path, os.path.join(self.directory, "proof_optimized.vcd")],
-                check=True,
                 cwd=self.directory,
                 stdout=open(self.verify_log, 'w'),
-            )
+            ),
+            files=[self.miter] + [os.path.join(defines.JASPER_SRCS, self.host.name, source) for source in ["run.tcl", "v_miter.sva", "sequence.rst"]],
+            texts=[version(defines.JASPER, "jg", "-version")]
+        )
 
         return self
-    
+
     def yosys_verify(self):
         self.yosys_verify_log = os.path.join(self.directory, "yosys_verify.log")
         self.yosys_proof_path = os.path.join(self.directory, "yosys_proof.S")
 
-        if not os.path.exists(self.yosys_verify_log):
+        def produce():
             with open(self.yosys_verify_log, 'w') as f:
                 f.write(datetime.datetime.now().strftime("%d-%m-%Y-%H-%M-%S-%f"))
                 f.flush()
 
-                subprocess.run(
-                    [defines.YOSYS_PATH, '-c', self.host.yosys_verify_script],
-                    check=True,
+                process.yosys.run(
+                    self.host.yosys_verify_script,
                     cwd=self.directory,
                     stdout=f
                 )
@@ -80,8 +104,18 @@ class Bug:
                         for line in yosys_verify_file:
                             if self.host.config.instruction_signal in line:
                                 dasm_input.append('DASM(' + line.split()[3] + ')\n')
-                        with open(self.yosys_proof_path, 'w') as yosys_proof_file:
-                            subprocess.run([defines.SPIKE_DASM_PATH], input=''.join(dasm_input[::2]), text=True, stdout=yosys_proof_file, check=True)
+                        with tempfile.TemporaryFile('w+') as dasm_file, open(self.yosys_proof_path, 'w') as yosys_proof_file:
+                            dasm_file.write(''.join(dasm_input[::2]))
+                            dasm_file.seek(0)
+                            process.run([defines.SPIKE_DASM_PATH], timeout=defines.TOOL_TIMEOUT, stdin=dasm_file, stdout=yosys_proof_file)
                         break
 
-        return self
\ No newline at end of file
+        self.host.cache.run(
+            "yosys_verify",
+            [self.yosys_verify_log, self.yosys_proof_path],
+            produce,
+            files=[os.path.join(self.directory, "miter.rtlil"), self.host.yosys_verify_script],
+            texts=[version(defines.YOSYS_PATH, "-V"), executable(defines.SPIKE_DASM_PATH), self.host.config.instruction_signal]
+        )
+
+        return self
@@ -0,0 +1,187 @@
+# Copyright 2024 Matej Bölcskei, ETH Zurich.
+# Licensed under the General Public License, Version 3.0, see LICENSE for details.
+# SPDX-License-Identifier: GPL-3.0-only
+
+import os
+import fcntl
+import shutil
+import hashlib
+import functools
+import subprocess
+import tempfile
+
+import defines
+import process
+
+digests = {}
+def digest(path):
+    stat = os.stat(path)
+    key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    if key not in digests:
+        file_digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                file_digest.update(chunk)
+        digests[key] = file_digest.hexdigest()
+    return digests[key]
+
+# the output identifies the tool whatever its exit status
+@functools.lru_cache(maxsize=None)
+def version(*command: str):
+    with tempfile.TemporaryFile('w+') as output:
+        try:
+            process.run(list(command), timeout=defines.TOOL_TIMEOUT, stdout=output, stderr=subprocess.DEVNULL)
+        except subprocess.CalledProcessError:
+            pass
+        output.seek(0)
+        return output.read()
+
+# tools without a version flag are identified by the contents of their executable
+@functools.lru_cache(maxsize=None)
+def executable(name: str):
+    return digest(shutil.which(name) or name)
+
+def remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+def link(source, destination):
+    if os.path.isdir(source):
+        for root, _, files in os.walk(source):
+            os.makedirs(os.path.join(destination, os.path.relpath(root, source)), exist_ok=True)
+            for name in files:
+                link(os.path.join(root, name), os.path.join(destination, os.path.relpath(root, source), name))
+    else:
+        try:
+            os.link(source, destination)
+        except OSError:
+            shutil.copy2(source, destination)
+
+def linked(source, destination):
+    if not os.path.exists(source):
+        return not os.path.lexists(destination)
+    if os.path.isdir(source):
+        return all(
+            linked(os.path.join(root, name), os.path.join(destination, os.path.relpath(root, source), name))
+            for root, _, files in os.walk(source) for name in files
+        )
+    return os.path.exists(destination) and os.path.samefile(source, destination)
+
+# Links the files of source that destination lacks or holds other contents for,
+# and leaves everything else in destination, such as files that other stages
+# write into a directory output, alone.
+def relink(source, destination):
+    if os.path.isdir(source):
+        for root, _, files in os.walk(source):
+            for name in files:
+                relink(os.path.join(root, name), os.path.join(destination, os.path.relpath(root, source), name))
+    elif not linked(source, destination):
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        remove(destination)
+        link(source, destination)
+
+# Outputs of a stage are stored once per key, i.e. per hash of the stage's input
+# files, scripts and tool versions, and hardlinked into every directory that asks
+# for them. Stored files are made read-only so that nothing writes through a link.
+class Cache:
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, stage: str, files: list[str], texts: list[str], outputs: list[str] = []):
+        key = hashlib.sha256(stage.encode())
+        for output in outputs:
+            key.update(hashlib.sha256(os.path.basename(output).encode()).hexdigest().encode())
+        for file in files:
+            key.update(digest(file).encode())
+        for text in texts:
+            key.update(hashlib.sha256(text.encode()).hexdigest().encode())
+        return key.hexdigest()
+
+    # outputs are stored by position, the key covers their names so that a stage
+    # whose outputs are renamed or reordered is not served the files of another,
+    # and a stage that is already being produced elsewhere is waited for, not rerun
+    def run(self, stage: str, outputs: list[str], produce, files: list[str] = [], texts: list[str] = []):
+        entry = os.path.join(self.directory, self.key(stage, files, texts, outputs))
+        if not os.path.isdir(entry):
+            with open(entry + ".lock", 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                if not os.path.isdir(entry):
+                    for output in outputs:
+                        remove(output)
+                    produce()
+                    self.store(entry, outputs)
+                    return True
+
+        for index, output in enumerate(outputs):
+            if os.path.exists(os.path.join(entry, str(index))):
+                relink(os.path.join(entry, str(index)), output)
+            elif not os.path.isdir(output):
+                remove(output)
+        return False
+
+    def store(self, entry, outputs):
+        staging = tempfile.mkdtemp(dir=self.directory, prefix=".")
+        os.chmod(staging, 0o755)
+        for index, output in enumerate(outputs):
+            if os.path.exists(output):
+                link(output, os.path.join(staging, str(index)))
+        for root, _, files in os.walk(staging):
+            for name in files:
+                mode = os.stat(os.path.join(root, name)).st_mode
+                os.chmod(os.path.join(root, name), mode & ~0o222)
+        try:
+            os.rename(staging, entry)
+        except OSError:
+            # stored concurrently by another worker
+            shutil.rmtree(staging)
+
+    # Returns a copy of path in the cache that is named by its contents, so that
+    # files referring to it by this path are the same in every working directory
+    def stored(self, path: str):
+        stored = os.path.join(self.directory, "files", digest(path) + os.path.splitext(path)[1])
+        if not os.path.exists(stored):
+            os.makedirs(os.path.dirname(stored), exist_ok=True)
+            temporary = f"{stored}.{os.getpid()}.tmp"
+            remove(temporary)
+            link(path, temporary)
+            os.replace(temporary, stored)
+        return stored
+
+    # Build directories are built once per key into a shared directory, with
+    # concurrent requests waiting for the first one, and then made read-only.
+    # Tools that write into their build directory while in use, such as make
+    # and cocotb, are given a linked copy of it by checkout.
+    def build(self, stage: str, build, files: list[str] = [], texts: list[str] = []):
+        directory = os.path.join(self.directory, "builds", self.key(stage, files, texts))
+        os.makedirs(os.path.dirname(directory), exist_ok=True)
+        with open(directory + ".lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.exists(directory + ".complete"):
+                remove(directory)
+                os.makedirs(directory)
+                build(directory)
+                for root, directories, names in os.walk(directory):
+                    for name in names:
+                        path = os.path.join(root, name)
+                        if not os.path.islink(path):
+                            os.chmod(path, os.stat(path).st_mode & ~0o222)
+                    for name in directories:
+                        os.chmod(os.path.join(root, name), 0o555)
+                os.chmod(directory, 0o555)
+                open(directory + ".complete", 'w').close()
+        return directory
+
+    # Replaces destination by a copy of a shared build directory whose files are
+    # hardlinks, so that their timestamps match and make finds nothing to rebuild.
+    # New files are created in the copy only; the linked files stay read-only.
+    def checkout(self, source: str, destination: str):
+        remove(destination)
+        link(source, destination)
+        for root, directories, _ in os.walk(destination):
+            for name in directories:
+                os.chmod(os.path.join(root, name), 0o755)
+        os.chmod(destination, 0o755)
+        return destination
@@ -0,0 +1,114 @@
+# Copyright 2024 Matej Bölcskei, ETH Zurich.
+# Licensed under the General Public License, Version 3.0, see LICENSE for details.
+# SPDX-License-Identifier: GPL-3.0-only
+
+import os
+import subprocess
+import time
+import datetime
+
+import defines
+import process
+import affinity
+from journal import atomic_open
+
+# Campaigns can announce detection candidates, either as log lines containing
+# detect_line or as new files in detect_directory. With early termination, a
+# candidate that is confirmed (by the confirm stage run on item, if given) stops
+# the campaign and the time to detection is written to detection_log.
+class Campaign:
+    def __init__(
+        self,
+        command: list[str],
+        cwd: str,
+        env: dict,
+        log: str,
+        detect_line: str = None,
+        detect_directory: str = None,
+        confirm = None,
+        item = None,
+        detection_log: str = None,
+        host = None
+    ):
+        self.command = command
+        self.cwd = cwd
+        self.env = env
+        self.log = log
+
+        self.detect_line = detect_line
+        self.detect_directory = detect_directory
+        self.confirm = confirm
+        self.item = item
+        self.detection_log = detection_log
+        self.host = host
+
+        self.log_offset = 0
+        self.seen_files = set()
+        self.detection = None
+        self.confirmations = 0
+        self.finished = False
+
+    def start(self, cpus: set[int] = None):
+        self.cpus = cpus
+        # left behind by an attempt that did not complete
+        if self.detection_log is not None and os.path.exists(self.detection_log):
+            os.remove(self.detection_log)
+        self.log_file = open(self.log, 'w')
+        with affinity.pinned(cpus):
+            self.process = process.popen(
+                self.command,
+                cwd=self.cwd,
+                stdout=self.log_file,
+                stderr=subprocess.DEVNULL,
+                env=self.env
+            )
+        self.start_time = datetime.datetime.now()
+        self.deadline = time.monotonic() + defines.FUZZING_TIMEOUT
+
+    def candidates(self):
+        candidates = []
+        if self.detect_line is not None:
+            with open(self.log, 'rb') as log:
+                log.seek(self.log_offset)
+                contents = log.read()
+            contents = contents[:contents.rfind(b"\n")+1]
+            self.log_offset += len(contents)
+            candidates += [line for line in contents.decode(errors='replace').splitlines() if self.detect_line in line]
+
+        # files are only announced once they have not been written to for a poll
+        # interval, so that a confirmation does not replay a partial input
+        if self.detect_directory is not None and os.path.isdir(self.detect_directory):
+            for name in sorted(os.listdir(self.detect_directory)):
+                path = os.path.join(self.detect_directory, name)
+                if name in self.seen_files or os.path.getsize(path) == 0:
+                    continue
+                if time.time() - os.path.getmtime(path) < defines.CAMPAIGN_POLL_INTERVAL:
+                    continue
+                self.seen_files.add(name)
+                candidates.append(name)
+
+        return candidates
+
+    def detect(self, candidate):
+        if self.finished or self.detection is not None:
+            return
+        self.detection = candidate
+        if self.detection_log is not None:
+            with atomic_open(self.detection_log) as detection_log:
+                detection_log.write(self.start_time.strftime("%d-%m-%Y-%H-%M-%S-%f") + "\n")
+                detection_log.write(candidate + "\n")
+                detection_log.write(datetime.datetime.now().strftime("%d-%m-%Y-%H-%M-%S-%f"))
+
+    def poll(self):
+        process.sample(self.process)
+        if self.detection is None and process.poll(self.process) is None and time.monotonic() < self.deadline:
+            return False
+        self.stop()
+        return True
+
+    def stop(self):
+        if self.finished:
+            return
+        process.kill(self.process)
+        self.log_file.close()
+        self.finished = True
@@ -4,6 +4,12 @@
 
 import os
 
+# peak resident memory in bytes and cores used by a single job of a kind of stage
+class Resources:
+    def __init__(self, memory: int, cores: int = 1):
+        self.memory = memory
+        self.cores = cores
+
 class EncarsiaConfig:
     def __init__(
         self,
@@ -21,7 +27,8 @@ class EncarsiaConfig:
         instruction_signal: str,
         cascade_directory: str,
         cascade_executable: str,
-        difuzzrtl_toplevel: str
+        difuzzrtl_toplevel: str,
+        resources: dict[str, Resources]
     ):
         # paths
         self.reference_sources = reference_sources
@@ -50,6 +57,9 @@ class EncarsiaConfig:
 
         self.difuzzrtl_toplevel = difuzzrtl_toplevel
 
+        # admission
+        self.resources = resources
+
 rocket_config = EncarsiaConfig(
     reference_sources = [
         os.path.abspath("/cascade-chipyard/cascade-rocket/src/dependencies/plusarg_reader.v"),
@@ -88,7 +98,12 @@ rocket_config = EncarsiaConfig(
     instruction_signal = "io_imem_resp_bits_data",
     cascade_directory = os.path.abspath("/cascade-chipyard/cascade-rocket"),
     cascade_executable = "Vtop_tiny_soc",
-    difuzzrtl_toplevel = "RocketTile"
+    difuzzrtl_toplevel = "RocketTile",
+    resources = {
+        "compile": Resources(8 << 30),
+        "fuzz": Resources(2 << 30),
+        "verify": Resources(8 << 30)
+    }
 )
 
 boom_config = EncarsiaConfig(
@@ -125,7 +140,12 @@ boom_config = EncarsiaConfig(
     instruction_signal = "io_ifu_fetchpacket_bits_uops_0_bits_inst",
     cascade_directory = os.path.abspath("/cascade-chipyard/cascade-boom"),
     cascade_executable = "Vtop_tiny_soc",
-    difuzzrtl_toplevel = "BoomTile"
+    difuzzrtl_toplevel = "BoomTile",
+    resources = {
+        "compile": Resources(24 << 30),
+        "fuzz": Resources(4 << 30),
+        "verify": Resources(16 << 30)
+    }
 )
 
 cva6_config = EncarsiaConfig(
@@ -147,7 +167,12 @@ cva6_config = EncarsiaConfig(
     instruction_signal = "frontend.fetch_entry_o",
     cascade_directory = os.path.abspath("/encarsia-cva6/cascade"),
     cascade_executable = "Variane_tiny_soc",
-    difuzzrtl_toplevel = ""
+    difuzzrtl_toplevel = "",
+    resources = {
+        "compile": Resources(16 << 30),
+        "fuzz": Resources(3 << 30),
+        "verify": Resources(8 << 30)
+    }
 )
 
 ibex_config = EncarsiaConfig(
@@ -169,7 +194,12 @@ ibex_config = EncarsiaConfig(
     instruction_signal = "instr_rdata_i",
     cascade_directory = os.path.abspath("/encarsia-ibex/cellift"),
     cascade_executable = "Vibex_tiny_soc",
-    difuzzrtl_toplevel = ""
+    difuzzrtl_toplevel = "",
+    resources = {
+        "compile": Resources(4 << 30),
+        "fuzz": Resources(1 << 30),
+        "verify": Resources(4 << 30)
+    }
 )
 
 def get_host_config(name: str):
@@ -7,6 +7,7 @@ import os
 YOSYS_PATH = "yosys"
 SPIKE_DASM_PATH = "spike-dasm"
 FUSESOC_PATH = "fusesoc"
+VERILATOR_PATH = "verilator"
 DIFUZZRTL_FUZZER = "/encarsia-difuzz-rtl/Fuzzer"
 DIFUZZRTL_VERILOG = "/encarsia-difuzz-rtl/Benchmarks/Verilog"
 PROCESSORFUZZ_FUZZER = "/encarsia-processorfuzz/Fuzzer"
@@ -15,4 +16,22 @@ CASCADE_PATH = "/encarsia-cascade/fuzzer/do_fuzzdesign.py"
 PREFILTER_PATH = "/encarsia-cascade/fuzzer/do_testsingle.py"
 JASPER = os.path.abspath("cds_jasper")
 JASPER_SRCS = os.path.abspath("./jasper")
-FUZZING_TIMEOUT = 1800
\ No newline at end of file
+FUZZING_TIMEOUT = 1800
+TERMINATION_TIMEOUT = 10
+CAMPAIGN_POLL_INTERVAL = 1
+STOP_POLL_INTERVAL = 0.5
+REPLAY_JOBS = 4
+SCHEMA_PLUSARG = "encarsia_bug"
+SCRATCH_RESERVE = 4 << 30
+SCRATCH_ESTIMATE = 2 << 30
+SCRATCH_MARGIN = 1.25
+BUILD_JOBS = 16
+MEMORY_RESERVE = 4 << 30
+MEMORY_MARGIN = 1.25
+GROUP_POLL_INTERVAL = 0.05
+STAGE_RETRIES = 1
+YOSYS_SHELLS = 4
+STAGE_TIMEOUT = 4 * 3600
+STAGE_TIMEOUTS = {"compile": 12 * 3600, "verify": 24 * 3600, "fuzz": 2 * FUZZING_TIMEOUT}
+STAGE_GRACE = 300
+TOOL_TIMEOUT = 600
@@ -6,7 +6,7 @@ import argparse
 import os
 import datetime
 import multiprocessing
-import subprocess
+import collections
 
 from host import Host
 from bug import Bug
@@ -16,26 +16,183 @@ from fuzzers.no_cov_difuzzrtl_dut import NoCovDifuzzRTLDUT
 from fuzzers.processorfuzz_dut import ProcessorfuzzDUT
 from fuzzers.no_cov_processorfuzz_dut import NoCovProcessorfuzzDUT
 from fuzzers.prefilter_dut import PrefilterDUT
+from schema import Schema
+from scheduler import Scheduler
+from cache import Cache
+from scratch import Scratch
+import defines
+import process
+from jobserver import jobserver
+from journal import journal
+import resources
+from resources import Profiles
+from affinity import Placement
+import retention
 import plot
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-d", "--directory", type=str, default=os.path.join(os.getcwd(), "out", datetime.datetime.now().strftime("%d-%m-%Y-%H-%M-%S")), help="Working directory.\nA new directory will be created if none is specified.")
+parser.add_argument("-C", "--cache", type=str, default=os.path.join(os.getcwd(), "out", "cache"), help="Artifact cache directory shared between runs")
+parser.add_argument("-T", "--scratch", type=str, help="Scratch directory, e.g. on a tmpfs, for build trees and simulation outputs")
+parser.add_argument("--scratch-budget", type=float, help="Space in GiB that directories on scratch may reserve, by default the size of the scratch filesystem")
 parser.add_argument("-H", "--hosts", type=str, nargs='+', help="List of host devices")
 parser.add_argument("-p", "--processes", type=int, default=32, help="Number of processes running in parallel")
+parser.add_argument("-j", "--jobs", type=int, help="Number of compile jobs shared by all concurrent builds, by default the number of CPUs the workers run on")
+parser.add_argument("-m", "--memory", type=float, help="Memory in GiB that running stages and campaigns may use, by default what is available at startup")
+parser.add_argument("-c", "--campaigns", type=int, default=len(os.sched_getaffinity(0)), help="Number of fuzzing campaigns running in parallel")
+parser.add_argument("-A", "--pin", action="store_true", help="Run each fuzzing campaign on a physical core of its own and all other stages on the remaining cores")
+parser.add_argument("--worker-cores", type=int, help="Number of physical cores kept for all other stages when pinning, by default half of them or what the campaigns leave if that is more")
+parser.add_argument("-r", "--retries", type=int, default=defines.STAGE_RETRIES, help="Number of times a failed stage is retried before the bug is given up on")
+parser.add_argument("-E", "--early-termination", action="store_true", help="Stop fuzzing campaigns once a detection is confirmed")
 parser.add_argument("-M", "--multiplexer-bugs", type=str, nargs='+', help="Multiplexer bugs to be verified and evaluated")
 parser.add_argument("-D", "--driver-bugs", type=str, nargs='+', help="Driver bugs to be verified and evaluated")
 parser.add_argument("-P", "--prefilter", action="store_true", help="Enable bug prefiltering")
 parser.add_argument("-V", "--verify", action="store_true", help="Enable bug verification")
 parser.add_argument("-Y", "--yosys-verify", action="store_true", help="Enable bug verification with Yosys")
+parser.add_argument("-S", "--schema", action="store_true", help="Fuzz all bugs of a host with Cascade from a single simulator build, selecting the bug at runtime")
+parser.add_argument("-W", "--yosys-workers", type=int, nargs='?', const=defines.YOSYS_SHELLS, default=0, help="Number of worker processes that run Yosys scripts in a persistent Yosys shell, each of which keeps a prepared reference per host resident")
+parser.add_argument("-R", "--retention", type=str, choices=["all", "results"], default="all", help="Artifacts kept in the working directory once a bug has finished its stages")
 parser.add_argument("-F", "--fuzzers", type=str, nargs='+', help="Fuzzers to be verified and evaluated")
 args = parser.parse_args()
 working_directory = os.path.abspath(args.directory)
 
+FUZZERS = {
+    "cascade": ("Cascade", CascadeDUT, [CascadeDUT.create_dut, CascadeDUT.compile_dut, CascadeDUT.campaign, CascadeDUT.check_fuzz]),
+    "difuzzrtl": ("DifuzzRTL", DifuzzRTLDUT, [DifuzzRTLDUT.create_dut, DifuzzRTLDUT.compile_dut, DifuzzRTLDUT.create_reference, DifuzzRTLDUT.compile_reference, DifuzzRTLDUT.campaign, DifuzzRTLDUT.check_mismatch]),
+    "no_cov_difuzzrtl": ("DifuzzRTL (no coverage)", NoCovDifuzzRTLDUT, [NoCovDifuzzRTLDUT.create_dut, NoCovDifuzzRTLDUT.compile_dut, NoCovDifuzzRTLDUT.create_reference, NoCovDifuzzRTLDUT.compile_reference, NoCovDifuzzRTLDUT.campaign, NoCovDifuzzRTLDUT.check_mismatch]),
+    "processorfuzz": ("ProcessorFuzz", ProcessorfuzzDUT, [ProcessorfuzzDUT.create_dut, ProcessorfuzzDUT.compile_dut, ProcessorfuzzDUT.create_reference, ProcessorfuzzDUT.compile_reference, ProcessorfuzzDUT.campaign, ProcessorfuzzDUT.check_mismatch]),
+    "no_cov_processorfuzz": ("ProcessorFuzz (no coverage)", NoCovProcessorfuzzDUT, [NoCovProcessorfuzzDUT.create_dut, NoCovProcessorfuzzDUT.compile_dut, NoCovProcessorfuzzDUT.create_reference, NoCovProcessorfuzzDUT.compile_reference, NoCovProcessorfuzzDUT.campaign, NoCovProcessorfuzzDUT.check_mismatch])
+}
+
+def supports(fuzzer, host):
+    return fuzzer == "cascade" or host.name != "ibex"
+
+process.yosys.shells = args.yosys_workers
+process.yosys.slots = os.path.join(working_directory, "yosys_shells")
+placement = Placement(args.campaigns, args.worker_cores) if args.pin else None
+# builds and formal checks only run on the workers' cores
+worker_cpus = len(placement.workers) if placement is not None else len(os.sched_getaffinity(0))
+jobserver.start(args.jobs or worker_cpus)
+scheduler = Scheduler(
+    args.processes,
+    args.campaigns,
+    args.early_termination,
+    Profiles(os.path.join(os.path.abspath(args.cache), "profiles.json")),
+    int(args.memory * (1 << 30)) if args.memory else resources.available_memory() - defines.MEMORY_RESERVE,
+    worker_cpus,
+    placement,
+    args.retries
+)
+verified_bugs = collections.defaultdict(list)
+fuzzed_duts = collections.defaultdict(list)
+pending_bugs = collections.Counter()
+schema_bugs = collections.defaultdict(list)
+unfinished_pipelines = collections.Counter()
+
+def bug_pipeline(bug):
+    bug = yield Bug.prepare, bug
+
+    if args.prefilter:
+        prefilter_dut = PrefilterDUT(bug.host, bug)
+        for stage in [PrefilterDUT.create_dut, PrefilterDUT.compile_dut, PrefilterDUT.fuzz]:
+            prefilter_dut = yield stage, prefilter_dut
+        with open(prefilter_dut.fuzz_log, 'r') as prefilter_log:
+            if "Success\n" not in prefilter_log.read():
+                return
+
+    if args.verify:
+        bug = yield Bug.create_miter, bug
+        bug = yield Bug.verify, bug
+        if not os.path.exists(bug.proof_path):
+            return
+
+    if args.yosys_verify:
+        bug = yield Bug.create_miter, bug
+        bug = yield Bug.yosys_verify, bug
+        verified_bugs[bug.host.name].append(bug)
+        if not os.path.exists(bug.yosys_proof_path):
+            return
+
+    for fuzzer in args.fuzzers or []:
+        if args.schema and fuzzer == "cascade":
+            unfinished_pipelines[bug.directory] += 1
+            schema_bugs[bug.host.name].append(bug)
+        elif supports(fuzzer, bug.host):
+            unfinished_pipelines[bug.directory] += 1
+            scheduler.start(fuzzer_pipeline(fuzzer, bug))
+
+# the schema of a host can only be built once all of its bugs went through bug_pipeline
+def schema_barrier(bug):
+    try:
+        yield from bug_pipeline(bug)
+    except Exception:
+        # recorded by the scheduler, the bug is not fuzzed
+        pass
+    pending_bugs[bug.host.name] -= 1
+    if not pending_bugs[bug.host.name] and schema_bugs[bug.host.name]:
+        scheduler.start(schema_pipeline(bug.host, schema_bugs[bug.host.name]))
+    yield from release(bug)
+
+# a bug's own intermediate files are discarded once its last pipeline has finished
+def release(bug):
+    unfinished_pipelines[bug.directory] -= 1
+    if args.retention == "results" and not unfinished_pipelines[bug.directory]:
+        yield retention.discard, (bug.directory, Bug.DISCARDED)
+        if args.prefilter:
+            yield retention.prune, (os.path.join(bug.directory, "prefilter"), ["fuzz.log"])
+
+def schema_pipeline(host, bugs):
+    try:
+        schema = yield Schema.create_dut, Schema(host, bugs)
+    except Exception:
+        for bug in bugs:
+            yield from release(bug)
+        return
+    for bug in bugs:
+        scheduler.start(fuzzer_pipeline("cascade", bug, schema))
+
+def fuzzer_pipeline(fuzzer, bug, schema=None):
+    _, dut_class, stages = FUZZERS[fuzzer]
+    dut = dut_class(bug.host, bug) if schema is None else dut_class(bug.host, bug, schema)
+    try:
+        for stage in stages:
+            if stage is dut_class.campaign:
+                campaign = dut.campaign()
+                if campaign is not None:
+                    yield campaign
+                    journal.record("campaign", dut.directory, dut_class.CAMPAIGN_OUTPUTS)
+            else:
+                dut = yield stage, dut
+        fuzzed_duts[(bug.host.name, fuzzer)].append(dut)
+    except Exception:
+        # recorded by the scheduler, the DUT's outputs are still kept
+        pass
+
+    yield bug.host.scratch.unstage, (dut.directory, dut_class.RETAINED)
+    if args.retention == "results":
+        yield retention.prune, (dut.directory, dut_class.RETAINED)
+    yield from release(bug)
+
 if __name__ == "__main__":
-    # TODO parallelize injection
-    for host in [Host(working_directory, name) for name in args.hosts]:
-        print(f"Injecting bugs into {host.name}")
-        host.inject()
+    for fuzzer in args.fuzzers or []:
+        if fuzzer not in FUZZERS:
+            raise Exception(f"Fuzzer '{fuzzer}' not found!")
+
+    process.mark_run()
+    journal.open(os.path.join(working_directory, "journal.jsonl"))
+    cache = Cache(os.path.abspath(args.cache))
+    scratch = Scratch(
+        os.path.abspath(args.scratch) if args.scratch else None,
+        int(args.scratch_budget * (1 << 30)) if args.scratch_budget is not None else None,
+        os.path.join(cache.directory, "scratch.json")
+    )
+    hosts = [Host(working_directory, name, cache, scratch) for name in args.hosts]
+    print(f"Injecting bugs into {', '.join(host.name for host in hosts)}")
+    with multiprocessing.Pool(processes=args.processes) as injection_pool:
+        injection_pool.starmap(Host.inject, [(host, driver) for host in hosts for driver in [False, True]])
+
+    bugs = []
+    for host in hosts:
         mux_directories = [name for name in os.listdir(host.mux_directory) if os.path.isdir(os.path.join(host.mux_directory, name))]
         driver_directories = [name for name in os.listdir(host.driver_directory) if os.path.isdir(os.path.join(host.driver_directory, name))]
         plot.save_injection_results(host)
@@ -53,144 +210,30 @@ if __name__ == "__main__":
                     raise Exception(f"Bug '{mux_bug}' not found in the working directory {working_directory}!")
             mux_directories = args.multiplexer_bugs
 
-        driver_bugs = [Bug(host, name, True) for name in driver_directories]
-        mux_bugs = [Bug(host, name, False) for name in mux_directories]
-        bugs = driver_bugs+mux_bugs
-        with multiprocessing.Pool(processes=args.processes) as verifier_pool:
-            bugs = verifier_pool.map(Bug.prepare, bugs)
-            
-            if args.prefilter:
-                prefilter_duts = [PrefilterDUT(host, bug) for bug in bugs]
-                print("Encapsulating buggy designs in wrapper modules for compatibility with the prefilter")
-                prefilter_duts = verifier_pool.map(PrefilterDUT.create_dut, prefilter_duts)
-                print("Compiling buggy designs for RTL simulation")
-                prefilter_duts = verifier_pool.map(PrefilterDUT.compile_dut, prefilter_duts)
-                print("Prefiltering")
-                prefilter_duts = verifier_pool.map(PrefilterDUT.fuzz, prefilter_duts)
-                subprocess.run(["stty", "echo"])
-
-                prefiltered_bugs = []
-                for bug in bugs:
-                    prefilter_log_path = os.path.join(bug.directory, "prefilter", "fuzz.log")
-                    if os.path.exists(prefilter_log_path):
-                        with open(prefilter_log_path, 'r') as prefilter_log:
-                            if "Success\n" in prefilter_log.read():
-                                prefiltered_bugs.append(bug)
-
-                bugs = prefiltered_bugs
-
-            if args.verify:
-                print("Creating miter circuits")
-                bugs = verifier_pool.map(Bug.create_miter, bugs)
-                print("Verifying bugs with JasperGold")
-                bugs = verifier_pool.map(Bug.verify, bugs)
-                bugs = [bug for bug in bugs if os.path.exists(bug.proof_path)]
-
-            if args.yosys_verify:
-                print("Creating miter circuits")
-                bugs = verifier_pool.map(Bug.create_miter, bugs)
-                print("Verifying bugs with Yosys")
-                bugs = verifier_pool.map(Bug.yosys_verify, bugs)
-                plot.save_verification_results(host, bugs)
-                
-                bugs = [bug for bug in bugs if os.path.exists(bug.yosys_proof_path)]
-
-            if args.fuzzers:
-                for fuzzer in args.fuzzers:
-                    if fuzzer == "cascade":
-                        print(f"Fuzzing {host.name} with Cascade")
-                        duts = [CascadeDUT(host, bug) for bug in bugs]
-                        print("Encapsulating buggy designs in wrapper modules for compatibility with the fuzzer")
-                        duts = verifier_pool.map(CascadeDUT.create_dut, duts)
-                        print("Compiling buggy designs for RTL simulation")
-                        duts = verifier_pool.map(CascadeDUT.compile_dut, duts)
-                        print("Fuzzing")
-                        duts = verifier_pool.map(CascadeDUT.fuzz, duts)
-                        subprocess.run(["stty", "echo"])
-                        plot.save_fuzzing_results(host, fuzzer, duts)
-                    elif fuzzer == "difuzzrtl":
-                        if host.name == "ibex":
-                            print("DifuzzRTL does not support Ibex, skipping!")
-                            continue
-                        print(f"Fuzzing {host.name} with DifuzzRTL")
-                        duts = [DifuzzRTLDUT(host, bug) for bug in bugs]
-                        print("Encapsulating buggy designs in wrapper modules for compatibility with the fuzzer")
-                        duts = verifier_pool.map(DifuzzRTLDUT.create_dut, duts)
-                        print("Compiling buggy designs for RTL simulation")
-                        duts = verifier_pool.map(DifuzzRTLDUT.compile_dut, duts)
-                        print("Fuzzing")
-                        duts = verifier_pool.map(DifuzzRTLDUT.fuzz, duts)
-                        print("Encapsulating reference designs in wrapper modules for compatibility with the fuzzer")
-                        duts = verifier_pool.map(DifuzzRTLDUT.create_reference, duts)
-                        print("Compiling reference designs for RTL simulation")
-                        duts = verifier_pool.map(DifuzzRTLDUT.compile_reference, duts)
-                        print("Filtering false positives")
-                        duts = verifier_pool.map(DifuzzRTLDUT.check_mismatch, duts)
-                        subprocess.run(["stty", "echo"])
-                        plot.save_fuzzing_results(host, fuzzer, duts)
-                    elif fuzzer == "no_cov_difuzzrtl":
-                        if host.name == "ibex":
-                            print("DifuzzRTL does not support Ibex, skipping!")
-                            continue
-                        print(f"Fuzzing {host.name} with DifuzzRTL (no coverage)")
-                        duts = [NoCovDifuzzRTLDUT(host, bug) for bug in bugs]
-                        print("Encapsulating buggy designs in wrapper modules for compatibility with the fuzzer")
-                        duts = verifier_pool.map(NoCovDifuzzRTLDUT.create_dut, duts)
-                        print("Compiling buggy designs for RTL simulation")
-                        duts = verifier_pool.map(NoCovDifuzzRTLDUT.compile_dut, duts)
-                        print("Fuzzing")
-                        duts = verifier_pool.map(NoCovDifuzzRTLDUT.fuzz, duts)
-                        print("Encapsulating reference designs in wrapper modules for compatibility with the fuzzer")
-                        duts = verifier_pool.map(NoCovDifuzzRTLDUT.create_reference, duts)
-                        print("Compiling reference designs for RTL simulation")
-                        duts = verifier_pool.map(NoCovDifuzzRTLDUT.compile_reference, duts)
-                        print("Filtering false positives")
-                        duts = verifier_pool.map(NoCovDifuzzRTLDUT.check_mismatch, duts)
-                        subprocess.run(["stty", "echo"])
-                        plot.save_fuzzing_results(host, fuzzer, duts)
-                    elif fuzzer == "processorfuzz":
-                        if host.name == "ibex":
-                            print("ProcessorFuzz does not support Ibex, skipping!")
-                            continue
-                        print(f"Fuzzing {host.name} with ProcessorFuzz")
-                        duts = [ProcessorfuzzDUT(host, bug) for bug in bugs]
-                        print("Encapsulating buggy designs in wrapper modules for compatibility with the fuzzer")
-                        duts = verifier_pool.map(ProcessorfuzzDUT.create_dut, duts)
-                        print("Compiling buggy designs for RTL simulation")
-                        duts = verifier_pool.map(ProcessorfuzzDUT.compile_dut, duts)
-                        print("Fuzzing")
-                        duts = verifier_pool.map(ProcessorfuzzDUT.fuzz, duts)
-                        print("Encapsulating reference designs in wrapper modules for compatibility with the fuzzer")
-                        duts = verifier_pool.map(ProcessorfuzzDUT.create_reference, duts)
-                        print("Compiling reference designs for RTL simulation")
-                        duts = verifier_pool.map(ProcessorfuzzDUT.compile_reference, duts)
-                        print("Filtering false positives")
-                        duts = verifier_pool.map(ProcessorfuzzDUT.check_mismatch, duts)
-                        subprocess.run(["stty", "echo"])
-                        plot.save_fuzzing_results(host, fuzzer, duts)
-                    elif fuzzer == "no_cov_processorfuzz":
-                        if host.name == "ibex":
-                            print("ProcessorFuzz does not support Ibex, skipping!")
-                            continue
-                        print(f"Fuzzing {host.name} with ProcessorFuzz (no coverage)")
-                        duts = [NoCovProcessorfuzzDUT(host, bug) for bug in bugs]
-                        print("Encapsulating buggy designs in wrapper modules for compatibility with the fuzzer")
-                        duts = verifier_pool.map(NoCovProcessorfuzzDUT.create_dut, duts)
-                        print("Compiling buggy designs for RTL simulation")
-                        duts = verifier_pool.map(NoCovProcessorfuzzDUT.compile_dut, duts)
-                        print("Fuzzing")
-                        duts = verifier_pool.map(NoCovProcessorfuzzDUT.fuzz, duts)
-                        print("Encapsulating reference designs in wrapper modules for compatibility with the fuzzer")
-                        duts = verifier_pool.map(NoCovProcessorfuzzDUT.create_reference, duts)
-                        print("Compiling reference designs for RTL simulation")
-                        duts = verifier_pool.map(NoCovProcessorfuzzDUT.compile_reference, duts)
-                        print("Filtering false positives")
-                        duts = verifier_pool.map(NoCovProcessorfuzzDUT.check_mismatch, duts)
-                        subprocess.run(["stty", "echo"])
-                        plot.save_fuzzing_results(host, fuzzer, duts)
-                    else:
-                        raise Exception(f"Fuzzer '{fuzzer}' not found!")
-                    
+        bugs += [Bug(host, name, True) for name in driver_directories]
+        bugs += [Bug(host, name, False) for name in mux_directories]
+
+        for fuzzer in args.fuzzers or []:
+            if not supports(fuzzer, host):
+                print(f"{FUZZERS[fuzzer][0]} does not support {host.name}, skipping!")
+
+    print(f"Processing {len(bugs)} bugs")
+    pending_bugs.update(bug.host.name for bug in bugs)
+    unfinished_pipelines.update(bug.directory for bug in bugs)
+    try:
+        scheduler.run(schema_barrier(bug) for bug in bugs)
+    finally:
+        process.kill_leaked()
+    if scheduler.failures:
+        print(f"{len(scheduler.failures)} stages failed, see failures.jsonl in the bug directories")
+
+    for host in hosts:
+        if args.yosys_verify:
+            plot.save_verification_results(host, verified_bugs[host.name])
+        for fuzzer in args.fuzzers or []:
+            if supports(fuzzer, host):
+                plot.save_fuzzing_results(host, fuzzer, fuzzed_duts[(host.name, fuzzer)])
+
     plot.plot_injection()
     plot.plot_verification()
     plot.plot_fuzzing()
\ No newline at end of file
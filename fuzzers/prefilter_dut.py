@@ -9,6 +9,11 @@ import random
 import string
 
 import defines
+from jobserver import jobserver
+import process
+import verilog
+from journal import journal
+from cache import version
 from host import Host
 from bug import Bug
 
@@ -23,7 +28,7 @@ class PrefilterDUT():
         if self.host.name == "ibex":
             self.env["CELLIFT_META_ROOT"] = "/encarsia-cellift"
             self.env["CELLIFT_DESIGN_PROCESSING_ROOT"] = "/encarsia-cellift/design-processing"
-            self.env["CELLIFT_JOBS"] = "250"
+            self.env["CELLIFT_JOBS"] = str(defines.BUILD_JOBS)
             self.env["CELLIFT_DATADIR"] = f'{os.path.join(self.directory, "experimental-data-cellift")}'
             self.env["CELLIFT_PYTHON_COMMON"] = "/encarsia-cellift/design-processing/common/python_scripts"
             self.env["CELLIFT_ENV_SOURCED"] = "yes"
@@ -40,7 +45,7 @@ class PrefilterDUT():
             
         self.env["CASCADE_META_ROOT"] = "/encarsia-cascade"
         self.env["CASCADE_DESIGN_PROCESSING_ROOT"] = "/encarsia-cascade/design-processing"
-        self.env["CASCADE_JOBS"] = "250"
+        self.env["CASCADE_JOBS"] = str(defines.BUILD_JOBS)
         self.env["CASCADE_DATADIR"] = f'{os.path.join(self.directory, "experimental-data")}'
         self.env["CASCADE_PYTHON_COMMON"] = "/encarsia-cascade/design-processing/common/python_scripts"
         self.env["CASCADE_RISCV_BITWIDTH"] = "64"
@@ -53,28 +58,33 @@ class PrefilterDUT():
 
     def create_dut(self):
         self.module = os.path.join(self.directory, "host.v")
-        if not os.path.exists(self.module):
-            subprocess.run(
-                [defines.YOSYS_PATH, '-c', self.host.export_script],
-                check=True,
+        self.host.cache.run(
+            "create_module",
+            [self.module],
+            lambda: process.yosys.run(
+                self.host.export_script,
                 cwd=self.directory,
                 stdout=subprocess.DEVNULL
-            )
+            ),
+            files=[os.path.join(self.bug.directory, "host.rtlil"), self.host.export_script],
+            texts=[version(defines.YOSYS_PATH, "-V")]
+        )
 
         self.dut_path = os.path.join(self.directory, "dut.v")
-        if not os.path.exists(self.dut_path):
-            with open(self.dut_path, 'w') as dut_file:
-                with open(self.host.cascade_receptor, 'r') as receptor_file:
-                    dut_file.write(receptor_file.read())
 
-                with open(self.module, 'r') as module_file:
-                    dut_file.write(module_file.read())
+        self.host.cache.run(
+            "create_dut",
+            [self.dut_path],
+            lambda: verilog.include(self.host.cache.stored(self.host.cascade_receptor), self.module, self.dut_path),
+            files=[self.host.cascade_receptor, self.module]
+        )
 
         return self
 
     def compile_dut(self):
         self.verilator_executable = os.path.join(self.directory, self.host.config.cascade_executable)
-        if not os.path.exists(self.verilator_executable):
+
+        def produce():
             with open(os.path.join(self.host.config.cascade_directory, "run_vanilla_notrace.core"), 'r') as core_source:
                 core = core_source.read()
                 core = core.replace("run_vanilla_notrace", self.name)
@@ -82,40 +92,67 @@ class PrefilterDUT():
                 with open(os.path.join(self.host.config.cascade_directory, self.name+".core"), 'w') as core_destination:
                     core_destination.write(core)
 
-            if self.host.name == "ibex":
-                subprocess.run(
-                    [defines.FUSESOC_PATH, '--cores-root=/encarsia-cellift/external-dependencies/cellift-opentitan', 'run', '--build', self.name],
-                    check=True,
-                    cwd=self.host.config.cascade_directory,
-                    env=self.env,
-                    stdout=open(os.path.join(self.directory, "build.log"), 'w'),
-                    stderr=subprocess.DEVNULL,
-                )
-            else:
-                subprocess.run(
-                    [defines.FUSESOC_PATH, 'run', '--build', self.name],
-                    check=True,
-                    cwd=self.host.config.cascade_directory,
-                    env=self.env,
-                    stdout=open(os.path.join(self.directory, "build.log"), 'w'),
-                    stderr=subprocess.DEVNULL,
-                )
-            shutil.copy(os.path.join(self.host.config.cascade_directory, "build", self.name+"_0.1", "default-verilator", self.host.config.cascade_executable), self.verilator_executable)
-            shutil.rmtree(os.path.join(self.host.config.cascade_directory, "build", self.name+"_0.1"))
-            os.remove(os.path.join(self.host.config.cascade_directory, self.name+".core"))
+            build_root = self.host.scratch.mkdtemp(self.name+"-", f"{self.host.name}-build")
+            build_options = ['--build-root', build_root] if build_root is not None else []
+            if build_root is None:
+                build_root = os.path.join(self.host.config.cascade_directory, "build", self.name+"_0.1")
+
+            # a failed build leaves neither its build root nor its core behind
+            try:
+                with jobserver.acquire(defines.BUILD_JOBS) as jobs:
+                    env = self.env.copy()
+                    for variable in ["CASCADE_JOBS", "CELLIFT_JOBS"]:
+                        if variable in env:
+                            env[variable] = str(jobs)
+
+                    if self.host.name == "ibex":
+                        process.run(
+                            [defines.FUSESOC_PATH, '--cores-root=/encarsia-cellift/external-dependencies/cellift-opentitan', 'run'] + build_options + ['--build', self.name],
+                            cwd=self.host.config.cascade_directory,
+                            env=env,
+                            stdout=open(os.path.join(self.directory, "build.log"), 'w'),
+                            stderr=subprocess.DEVNULL,
+                        )
+                    else:
+                        process.run(
+                            [defines.FUSESOC_PATH, 'run'] + build_options + ['--build', self.name],
+                            cwd=self.host.config.cascade_directory,
+                            env=env,
+                            stdout=open(os.path.join(self.directory, "build.log"), 'w'),
+                            stderr=subprocess.DEVNULL,
+                        )
+                shutil.copy(os.path.join(build_root, "default-verilator", self.host.config.cascade_executable), self.verilator_executable)
+            finally:
+                self.host.scratch.release(build_root)
+                os.remove(os.path.join(self.host.config.cascade_directory, self.name+".core"))
+
+        self.host.cache.run(
+            "compile_cascade",
+            [self.verilator_executable],
+            produce,
+            files=[self.dut_path, self.host.cascade_receptor, os.path.join(self.host.config.cascade_directory, "run_vanilla_notrace.core")],
+            texts=[self.host.name, self.host.config.cascade_directory, version(defines.VERILATOR_PATH, "--version")]
+        )
 
         return self
 
     def fuzz(self):
         self.fuzz_log = os.path.join(self.directory, "fuzz.log")
-        if not os.path.exists(self.fuzz_log):
-            subprocess.run(
-                ["python", defines.PREFILTER_PATH, self.host.name, self.verilator_executable],
-                check=True,
-                cwd=self.host.config.cascade_directory,
-                stdout=open(self.fuzz_log, 'w'),
-                stderr=subprocess.DEVNULL,
-                env=self.env
-            )
+        if not journal.completed("prefilter", self.directory):
+            for datadir in ["CASCADE_DATADIR", "CELLIFT_DATADIR"]:
+                if datadir in self.env:
+                    self.host.scratch.clear(self.env[datadir])
+                    self.host.scratch.stage(self.env[datadir])
+            try:
+                process.run(
+                    ["python", defines.PREFILTER_PATH, self.host.name, self.verilator_executable],
+                    cwd=self.host.config.cascade_directory,
+                    stdout=open(self.fuzz_log, 'w'),
+                    stderr=subprocess.DEVNULL,
+                    env=self.env
+                )
+            finally:
+                self.host.scratch.unstage((self.directory, []))
+            journal.record("prefilter", self.directory, ["fuzz.log"])
         
         return self
\ No newline at end of file
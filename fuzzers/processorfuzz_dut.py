@@ -6,13 +6,25 @@ import os
 import subprocess
 import random
 import string
-import time
+import threading
+import contextlib
+import concurrent.futures
 
 import defines
+from jobserver import jobserver
+import process
+import verilog
+from journal import journal, atomic_open
+from cache import version, link, digest, remove
+from campaign import Campaign
 from host import Host
 from bug import Bug
 
 class ProcessorfuzzDUT():
+    # what a finished DUT keeps for plot.py and for resuming its pipeline
+    CAMPAIGN_OUTPUTS = ["fuzz.log", "out"]
+    RETAINED = ["fuzz.log", "detection.log", "check_summary.log", os.path.join("out", "mismatch", "sim_input")]
+
     def __init__(self, host: Host, bug: Bug):
         self.directory = os.path.join(bug.directory, "processorfuzz")
         os.makedirs(self.directory, exist_ok=True)
@@ -28,52 +40,92 @@ class ProcessorfuzzDUT():
 
     def create_dut(self):
         self.module = os.path.join(self.directory, "host.v")
-        if not os.path.exists(self.module):
-            subprocess.run(
-                [defines.YOSYS_PATH, '-c', self.host.instrument_script],
-                check=True,
+        self.host.cache.run(
+            "create_module",
+            [self.module],
+            lambda: process.yosys.run(
+                self.host.instrument_script,
                 cwd=self.directory,
                 stdout=subprocess.DEVNULL
-            )
+            ),
+            files=[os.path.join(self.bug.directory, "host.rtlil"), self.host.instrument_script],
+            texts=[version(defines.YOSYS_PATH, "-V")]
+        )
 
         self.dut_path = os.path.join(self.directory, "dut.v")
-        if not os.path.exists(self.dut_path):
-            with open(self.dut_path, 'w') as dut_file:
-                with open(self.host.processorfuzz_receptor, 'r') as receptor_file:
-                    dut_file.write(receptor_file.read())
 
-                with open(self.module, 'r') as module_file:
-                    dut_file.write(module_file.read())
+        self.host.cache.run(
+            "create_dut",
+            [self.dut_path],
+            lambda: verilog.include(self.host.cache.stored(self.host.processorfuzz_receptor), self.module, self.dut_path),
+            files=[self.host.processorfuzz_receptor, self.module]
+        )
 
         return self
     
     def create_reference(self):
         self.reference = os.path.join(self.directory, "reference.v")
-        if not os.path.exists(self.reference):
-            subprocess.run(
-                [defines.YOSYS_PATH, '-c', self.host.export_difuzzrtl_reference],
-                check=True,
+        self.host.cache.run(
+            "create_reference_module",
+            [self.reference],
+            lambda: process.yosys.run(
+                self.host.export_difuzzrtl_reference,
                 cwd=self.directory,
                 stdout=subprocess.DEVNULL
-            )
+            ),
+            files=[os.path.join(self.bug.directory, "reference.rtlil"), self.host.export_difuzzrtl_reference],
+            texts=[version(defines.YOSYS_PATH, "-V")]
+        )
 
         self.reference_dut = os.path.join(self.directory, "reference_dut.v")
-        if not os.path.exists(self.reference_dut):
-            with open(self.reference_dut, 'w') as reference_dut_file:
-                with open(self.host.processorfuzz_receptor, 'r') as receptor_file:
-                    reference_dut_file.write(receptor_file.read())
 
-                with open(self.reference, 'r') as reference_file:
-                    reference_dut_file.write(reference_file.read())
+        self.host.cache.run(
+            "create_dut",
+            [self.reference_dut],
+            lambda: verilog.include(self.host.cache.stored(self.host.processorfuzz_receptor), self.reference, self.reference_dut),
+            files=[self.host.processorfuzz_receptor, self.reference]
+        )
 
         return self
     
     def compile_dut(self):
-        self.build_directory = os.path.join(self.directory, "build")
         self.out_directory = os.path.join(self.directory, "out")
 
-        if not os.path.exists(self.out_directory):
-            subprocess.run(
+        def build(directory):
+            link(self.dut_path, os.path.join(directory, "dut.v"))
+            with jobserver.acquire(defines.BUILD_JOBS) as jobs:
+                process.run(
+                    [
+                        "make",
+                        f"SIM_BUILD={os.path.relpath(os.path.join(directory, 'build'), defines.PROCESSORFUZZ_FUZZER)}",
+                        f"VFILE={os.path.relpath(os.path.join(directory, 'dut'), defines.PROCESSORFUZZ_VERILOG)}",
+                        f"TOPLEVEL={self.host.config.difuzzrtl_toplevel}",
+                        f"NUM_ITER=1",
+                        f"OUT={os.path.relpath(os.path.join(directory, 'out'), defines.PROCESSORFUZZ_FUZZER)}",
+                        f"ALL_CSR=0",
+                        f"FP_CSR=0"
+                    ],
+                    cwd=defines.PROCESSORFUZZ_FUZZER,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    env=dict(self.env, MAKEFLAGS=f"-j{jobs}")
+                )
+
+        self.dut_build = self.host.cache.build(
+            "compile_processorfuzz_dut",
+            build,
+            files=[self.dut_path, self.host.processorfuzz_receptor],
+            texts=[defines.PROCESSORFUZZ_FUZZER, self.host.config.difuzzrtl_toplevel, "ALL_CSR=0", "FP_CSR=0", version(defines.VERILATOR_PATH, "--version")]
+        )
+        # simulations write into their build directory, so each DUT runs in its own copy
+        self.build_directory = self.host.cache.checkout(os.path.join(self.dut_build, "build"), os.path.join(self.directory, "build"))
+        self.dut_path = os.path.join(self.dut_build, "dut.v")
+
+        # the output directory of a campaign that did not complete is started afresh
+        if not journal.completed("campaign", self.directory):
+            self.host.scratch.clear(self.out_directory)
+            self.host.scratch.stage(self.out_directory)
+            process.run(
                 [
                     "make",
                     f"SIM_BUILD={os.path.relpath(self.build_directory, defines.PROCESSORFUZZ_FUZZER)}",
@@ -84,7 +136,6 @@ class ProcessorfuzzDUT():
                     f"ALL_CSR=0",
                     f"FP_CSR=0"
                 ],
-                check=True,
                 cwd=defines.PROCESSORFUZZ_FUZZER,
                 stdout=subprocess.DEVNULL,
                 stderr=subprocess.DEVNULL,
@@ -93,38 +144,68 @@ class ProcessorfuzzDUT():
 
         return self
     
-    def fuzz(self):
+    def campaign(self):
         self.fuzz_log = os.path.join(self.directory, "fuzz.log")
-        if not os.path.exists(self.fuzz_log):
-            with open(self.fuzz_log, 'w') as fuzz_log:
-                process = subprocess.Popen(
+        if not journal.completed("campaign", self.directory):
+            return Campaign(
+                [
+                    "make",
+                    f"SIM_BUILD={os.path.relpath(self.build_directory, defines.PROCESSORFUZZ_FUZZER)}",
+                    f"VFILE={os.path.relpath(self.dut_path[:-2], defines.PROCESSORFUZZ_VERILOG)}",
+                    f"TOPLEVEL={self.host.config.difuzzrtl_toplevel}",
+                    f"NUM_ITER=10000000",
+                    f"OUT={os.path.relpath(self.out_directory, defines.PROCESSORFUZZ_FUZZER)}",
+                    f"ALL_CSR=0",
+                    f"FP_CSR=0"
+                ],
+                cwd=defines.PROCESSORFUZZ_FUZZER,
+                env=self.env,
+                log=self.fuzz_log,
+                detect_directory=os.path.join(self.out_directory, "mismatch", "sim_input"),
+                confirm=type(self).check_input,
+                item=self,
+                detection_log=os.path.join(self.directory, "detection.log"),
+                host=self.host
+            )
+
+    def compile_reference(self):
+        self.out_reference_directory = os.path.join(self.directory, "out_reference")
+
+        def build(directory):
+            link(self.reference_dut, os.path.join(directory, "reference_dut.v"))
+            with jobserver.acquire(defines.BUILD_JOBS) as jobs:
+                process.run(
                     [
                         "make",
-                        f"SIM_BUILD={os.path.relpath(self.build_directory, defines.PROCESSORFUZZ_FUZZER)}",
-                        f"VFILE={os.path.relpath(self.dut_path[:-2], defines.PROCESSORFUZZ_VERILOG)}",
+                        f"SIM_BUILD={os.path.relpath(os.path.join(directory, 'build'), defines.PROCESSORFUZZ_FUZZER)}",
+                        f"VFILE={os.path.relpath(os.path.join(directory, 'reference_dut'), defines.PROCESSORFUZZ_VERILOG)}",
                         f"TOPLEVEL={self.host.config.difuzzrtl_toplevel}",
-                        f"NUM_ITER=10000000",
-                        f"OUT={os.path.relpath(self.out_directory, defines.PROCESSORFUZZ_FUZZER)}",
+                        f"NUM_ITER=1",
+                        f"OUT={os.path.relpath(os.path.join(directory, 'out'), defines.PROCESSORFUZZ_FUZZER)}",
                         f"ALL_CSR=0",
                         f"FP_CSR=0"
                     ],
                     cwd=defines.PROCESSORFUZZ_FUZZER,
-                    stdout=fuzz_log,
+                    stdout=subprocess.DEVNULL,
                     stderr=subprocess.DEVNULL,
-                    env=self.env
+                    env=dict(self.env, MAKEFLAGS=f"-j{jobs}")
                 )
-                time.sleep(defines.FUZZING_TIMEOUT)
-                process.terminate()
 
-        return self
-    
-    def compile_reference(self):
-        self.build_reference_directory = os.path.join(self.directory, "build_reference")
-        self.out_reference_directory = os.path.join(self.directory, "out_reference")
+        self.reference_build = self.host.cache.build(
+            "compile_processorfuzz_reference",
+            build,
+            files=[self.reference_dut, self.host.processorfuzz_receptor],
+            texts=[defines.PROCESSORFUZZ_FUZZER, self.host.config.difuzzrtl_toplevel, "ALL_CSR=0", "FP_CSR=0", version(defines.VERILATOR_PATH, "--version")]
+        )
+        self.build_reference_directory = self.host.cache.checkout(os.path.join(self.reference_build, "build"), os.path.join(self.directory, "build_reference"))
+        self.reference_dut = os.path.join(self.reference_build, "reference_dut.v")
+
         self.out_replay_directory = os.path.join(self.directory, "out_replay")
 
-        if not os.path.exists(self.out_reference_directory):
-            subprocess.run(
+        if not journal.completed("initialize_reference", self.directory):
+            self.host.scratch.clear(self.out_reference_directory)
+            self.host.scratch.stage(self.out_reference_directory)
+            process.run(
                 [
                     "make",
                     f"SIM_BUILD={os.path.relpath(self.build_reference_directory, defines.PROCESSORFUZZ_FUZZER)}",
@@ -135,15 +216,18 @@ class ProcessorfuzzDUT():
                     f"ALL_CSR=0",
                     f"FP_CSR=0"
                 ],
-                check=True,
                 cwd=defines.PROCESSORFUZZ_FUZZER,
                 stdout=subprocess.DEVNULL,
                 stderr=subprocess.DEVNULL,
                 env=self.env
             )
+            journal.record("initialize_reference", self.directory, ["out_reference"])
 
-        if not os.path.exists(self.out_replay_directory):
-            subprocess.run(
+        # replays of the inputs of a campaign that did not complete are stale
+        if not journal.completed("initialize_replay", self.directory) or not journal.completed("campaign", self.directory):
+            self.host.scratch.clear(self.out_replay_directory)
+            self.host.scratch.stage(self.out_replay_directory)
+            process.run(
                 [
                     "make",
                     f"SIM_BUILD={os.path.relpath(self.build_directory, defines.PROCESSORFUZZ_FUZZER)}",
@@ -154,18 +238,12 @@ class ProcessorfuzzDUT():
                     f"ALL_CSR=0",
                     f"FP_CSR=0"
                 ],
-                check=True,
                 cwd=defines.PROCESSORFUZZ_FUZZER,
                 stdout=subprocess.DEVNULL,
                 stderr=subprocess.DEVNULL,
                 env=self.env
             )
-
-        return self
-    
-    def check_mismatch(self):
-        mismatch_inputs = os.listdir(os.path.join(self.out_directory, "mismatch", "sim_input"))
-        self.check_summary = os.path.join(self.directory, "check_summary.log")
+            journal.record("initialize_replay", self.directory, ["out_replay"])
 
         if not os.path.isdir(os.path.join(self.out_reference_directory, "mismatch", "check")):
             os.makedirs(os.path.join(self.out_reference_directory, "mismatch", "check"))
@@ -173,61 +251,116 @@ class ProcessorfuzzDUT():
         if not os.path.isdir(os.path.join(self.out_replay_directory, "mismatch", "check")):
             os.makedirs(os.path.join(self.out_replay_directory, "mismatch", "check"))
 
-        for input in mismatch_inputs:
-            log_replay = os.path.join(self.out_replay_directory, "mismatch", "check", input[:-3]+"_replay.log")
-            if not os.path.exists(log_replay):
-                subprocess.run(
+        return self
+    
+    # replays run side by side, so each one writes its results file and outputs
+    # into its own directory, laid out like the initialized output directory
+    @contextlib.contextmanager
+    def replay_directory(self, out, input):
+        directory = os.path.join(self.directory, "replays", os.path.basename(out), input[:-3])
+        remove(directory)
+        for root, _, _ in os.walk(out):
+            os.makedirs(os.path.join(directory, os.path.relpath(root, out)), exist_ok=True)
+        try:
+            yield directory, dict(self.env, COCOTB_RESULTS_FILE=os.path.join(directory, "results.xml"))
+        finally:
+            remove(directory)
+
+    # the DUT and the reference replay of an input are independent and run side by side
+    def check_input(self, input, stop=None):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            replay = executor.submit(self.replay_dut, input, stop)
+            reference = executor.submit(self.replay_reference, input, stop)
+            return replay.result() and reference.result()
+
+    def replay_dut(self, input, stop=None):
+        log_replay = os.path.join(self.out_replay_directory, "mismatch", "check", input[:-3]+"_replay.log")
+        if not os.path.exists(log_replay):
+            with self.replay_directory(self.out_replay_directory, input) as (out, env):
+                process.run(
                     [
                         "make",
                         f"SIM_BUILD={os.path.relpath(self.build_directory, defines.PROCESSORFUZZ_FUZZER)}",
                         f"VFILE={os.path.relpath(self.dut_path[:-2], defines.PROCESSORFUZZ_VERILOG)}",
                         f"TOPLEVEL={self.host.config.difuzzrtl_toplevel}",
                         f"NUM_ITER=1",
-                        f"OUT={os.path.relpath(self.out_replay_directory, defines.PROCESSORFUZZ_FUZZER)}",
+                        f"OUT={os.path.relpath(out, defines.PROCESSORFUZZ_FUZZER)}",
                         f"IN_FILE={os.path.relpath(os.path.join(self.out_directory, 'mismatch', 'sim_input', input), defines.PROCESSORFUZZ_FUZZER)}",
                         f"ALL_CSR=0",
                         f"FP_CSR=0"
                     ],
-                    check=True,
+                    stop=stop,
                     cwd=defines.PROCESSORFUZZ_FUZZER,
-                    stdout=open(log_replay, 'w'),
+                    stdout=open(log_replay + ".tmp", 'w'),
                     stderr=subprocess.DEVNULL,
-                    env=self.env
+                    env=env
                 )
-            with open(log_replay, 'r') as log_file:
-                contents = log_file.read()
-                if "MISMATCH:" not in contents and "Bug --" not in contents:
-                    continue
-
-            log = os.path.join(self.out_reference_directory, "mismatch", "check", input[:-3]+".log")
-            if not os.path.exists(log):
-                subprocess.run(
+            os.replace(log_replay + ".tmp", log_replay)
+        with open(log_replay, 'r') as log_file:
+            contents = log_file.read()
+            return "MISMATCH:" in contents or "Bug --" in contents
+
+    def replay_reference(self, input, stop=None):
+        log = os.path.join(self.out_reference_directory, "mismatch", "check", input[:-3]+".log")
+        def replay():
+            with self.replay_directory(self.out_reference_directory, input) as (out, env):
+                process.run(
                     [
                         "make",
                         f"SIM_BUILD={os.path.relpath(self.build_reference_directory, defines.PROCESSORFUZZ_FUZZER)}",
                         f"VFILE={os.path.relpath(self.reference_dut[:-2], defines.PROCESSORFUZZ_VERILOG)}",
                         f"TOPLEVEL={self.host.config.difuzzrtl_toplevel}",
                         f"NUM_ITER=1",
-                        f"OUT={os.path.relpath(self.out_reference_directory, defines.PROCESSORFUZZ_FUZZER)}",
+                        f"OUT={os.path.relpath(out, defines.PROCESSORFUZZ_FUZZER)}",
                         f"IN_FILE={os.path.relpath(os.path.join(self.out_directory, 'mismatch', 'sim_input', input), defines.PROCESSORFUZZ_FUZZER)}",
                         f"ALL_CSR=0",
                         f"FP_CSR=0"
                     ],
-                    check=True,
+                    stop=stop,
                     cwd=defines.PROCESSORFUZZ_FUZZER,
                     stdout=open(log, 'w'),
                     stderr=subprocess.DEVNULL,
-                    env=self.env
+                    env=env
                 )
 
-            with open(log, 'r') as log_file:
-                contents = log_file.read()
-                if "MISMATCH:" not in contents and "Bug --" not in contents:
-                    with open(self.check_summary, 'w') as check_summary_file:
-                        check_summary_file.write("DETECTED: "+input)
-                    return self
-                
-        with open(self.check_summary, 'w') as check_summary_file:
-            check_summary_file.write("NOT DETECTED")
+        self.host.cache.run(
+            "replay_reference",
+            [log],
+            replay,
+            files=[os.path.join(self.out_directory, "mismatch", "sim_input", input)],
+            texts=[os.path.basename(self.reference_build)]
+        )
+
+        with open(log, 'r') as log_file:
+            contents = log_file.read()
+            return "MISMATCH:" not in contents and "Bug --" not in contents
+
+    def check_mismatch(self):
+        # the harness reads a single IN_FILE per run, so every replay pays for
+        # starting make, cocotb and the simulator; inputs with identical contents
+        # are replayed once, which saves replays but not the cost of each one
+        sim_input = os.path.join(self.out_directory, "mismatch", "sim_input")
+        mismatch_inputs = {}
+        for input in sorted(os.listdir(sim_input)):
+            mismatch_inputs.setdefault(digest(os.path.join(sim_input, input)), input)
+        mismatch_inputs = list(mismatch_inputs.values())
+        self.check_summary = os.path.join(self.directory, "check_summary.log")
+
+        # replays run concurrently and are stopped as soon as one input detects the bug
+        stop = threading.Event()
+        detected = None
+        with concurrent.futures.ThreadPoolExecutor(max_workers=defines.REPLAY_JOBS) as executor:
+            replays = {executor.submit(self.check_input, input, stop): input for input in mismatch_inputs}
+            try:
+                for replay in concurrent.futures.as_completed(replays):
+                    if replay.result():
+                        detected = replays[replay]
+                        break
+            finally:
+                stop.set()
+                executor.shutdown(cancel_futures=True)
+
+        with atomic_open(self.check_summary) as check_summary_file:
+            check_summary_file.write("NOT DETECTED" if detected is None else "DETECTED: "+detected)
 
         return self
\ No newline at end of file
@@ -0,0 +1,43 @@
+# Copyright 2024 Matej Bölcskei, ETH Zurich.
+# Licensed under the General Public License, Version 3.0, see LICENSE for details.
+# SPDX-License-Identifier: GPL-3.0-only
+
+import os
+import contextlib
+import multiprocessing
+
+# A token pipe in the format of the GNU make jobserver, holding one token per job
+# the machine should run. Builds take their tokens before they start and pass
+# their number on to make and FuseSoC, so that the total number of compile jobs
+# stays within the budget however many builds the pool runs at once. The pipe
+# and lock are inherited by the pool workers, so start must be called before
+# the pool is created.
+class Jobserver:
+    def __init__(self):
+        self.jobs = None
+
+    def start(self, jobs: int):
+        self.jobs = jobs
+        self.lock = multiprocessing.Lock()
+        self.read, self.write = os.pipe()
+        os.write(self.write, b"+" * jobs)
+
+    @contextlib.contextmanager
+    def acquire(self, jobs: int):
+        if self.jobs is None:
+            yield jobs
+            return
+
+        jobs = max(1, min(jobs, self.jobs))
+        # tokens are taken by one build at a time so that no two builds can each
+        # hold part of what the other is waiting for
+        tokens = b""
+        with self.lock:
+            while len(tokens) < jobs:
+                tokens += os.read(self.read, jobs - len(tokens))
+        try:
+            yield jobs
+        finally:
+            os.write(self.write, tokens)
+
+jobserver = Jobserver()
@@ -0,0 +1,59 @@
+# Copyright 2024 Matej Bölcskei, ETH Zurich.
+# Licensed under the General Public License, Version 3.0, see LICENSE for details.
+# SPDX-License-Identifier: GPL-3.0-only
+
+import os
+import json
+import contextlib
+
+# Writes path by renaming a completed temporary file over it, so that path is
+# either missing or complete, however the run ends
+@contextlib.contextmanager
+def atomic_open(path: str, mode: str = 'w'):
+    with open(path + ".tmp", mode) as temporary_file:
+        yield temporary_file
+        temporary_file.flush()
+        os.fsync(temporary_file.fileno())
+    os.replace(path + ".tmp", path)
+
+# Steps whose outputs are not stored by the cache, such as campaigns and the
+# simulation output directories they write to, are recorded in the journal of
+# the working directory once they have completed. A restarted run redoes every
+# step that is not in the journal, or whose recorded outputs have since gone
+# missing, e.g. with the scratch directory they were staged on. Records are
+# appended by whichever process completes the step, the journal as of the
+# start of the run is inherited by the pool workers, so open must be called
+# before the pool is created.
+class Journal:
+    def __init__(self):
+        self.path = None
+        self.entries = {}
+
+    def open(self, path: str):
+        self.path = path
+        if os.path.exists(self.path):
+            with open(self.path, 'rb+') as journal_file:
+                contents = journal_file.read()
+                # the last record may be torn by a crash, and is dropped so that
+                # the next one is appended on a line of its own
+                contents = contents[:contents.rfind(b"\n")+1]
+                journal_file.truncate(len(contents))
+            for line in contents.decode().splitlines():
+                entry = json.loads(line)
+                self.entries[(entry["step"], entry["directory"])] = entry["outputs"]
+
+    def completed(self, step: str, directory: str):
+        outputs = self.entries.get((step, directory))
+        return outputs is not None and all(os.path.exists(os.path.join(directory, output)) for output in outputs)
+
+    # outputs are relative to directory
+    def record(self, step: str, directory: str, outputs: list[str] = []):
+        self.entries[(step, directory)] = outputs
+        if self.path is None:
+            return
+        with open(self.path, 'a') as journal_file:
+            journal_file.write(json.dumps({"step": step, "directory": directory, "outputs": outputs}) + "\n")
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+
+journal = Journal()
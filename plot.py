@@ -55,12 +55,15 @@ def plot_verification():
 
 fuzzing_data = []
 totals = []
+detection_times = []
 max_bugs = 0
 def save_fuzzing_results(host, fuzzer, duts):
     global max_bugs
     success_driver = []
     success_multiplexer = []
     duts.sort(key=lambda x: int(x.bug.name))
+    times_driver = []
+    times_multiplexer = []
     for dut in duts:
         with open(dut.check_summary, 'r') as check_summary_file:
             detected = "✘" if "NOT DETECTED" in check_summary_file.read() else "✔"
@@ -69,12 +72,19 @@ def save_fuzzing_results(host, fuzzer, duts):
             else:
                 success_multiplexer.append(detected)
 
+        # written by campaigns stopped early on a confirmed detection
+        detection_log = os.path.join(dut.directory, "detection.log")
+        if os.path.exists(detection_log):
+            (times_driver if dut.bug.driver else times_multiplexer).append(read_duration(detection_log).total_seconds())
+
     driver_data = [host.name, "Mix-up", fuzzer]
     driver_data.extend(success_driver)
     totals.append(sum([1 if success == "✔" else 0 for success in success_driver]))
+    detection_times.append(sum(times_driver)/len(times_driver) if len(times_driver) > 0 else "-")
     multiplexer_data = [host.name, "Conditional", fuzzer]
     multiplexer_data.extend(success_multiplexer)
     totals.append(sum([1 if success == "✔" else 0 for success in success_multiplexer]))
+    detection_times.append(sum(times_multiplexer)/len(times_multiplexer) if len(times_multiplexer) > 0 else "-")
     fuzzing_data.append(driver_data)
     fuzzing_data.append(multiplexer_data)
     if len(success_driver) > max_bugs:
@@ -86,9 +96,11 @@ def plot_fuzzing():
     fuzzing_headers = ["Design", "Bug Category", "Fuzzer"]
     fuzzing_headers.extend(range(1, max_bugs+1))
     fuzzing_headers.append("Total")
+    fuzzing_headers.append("Avg. T. to Detection")
     for row in fuzzing_data:
-        row.extend(["-" for _ in range(len(fuzzing_headers) - len(row) - 1)])
+        row.extend(["-" for _ in range(len(fuzzing_headers) - len(row) - 2)])
         row.append(totals.pop(0))
+        row.append(detection_times.pop(0))
         
     print("\nFuzzing results:")
     print(tabulate.tabulate(fuzzing_data, headers=fuzzing_headers, stralign="center", numalign="right", tablefmt="grid"))
\ No newline at end of file
@@ -0,0 +1,362 @@
+# Copyright 2024 Matej Bölcskei, ETH Zurich.
+# Licensed under the General Public License, Version 3.0, see LICENSE for details.
+# SPDX-License-Identifier: GPL-3.0-only
+
+import os
+import time
+import fcntl
+import signal
+import subprocess
+import threading
+
+import defines
+
+class Stopped(Exception):
+    pass
+
+# Every tool is started in a session of its own, whose process group holds the
+# simulators, compilers and shells it starts in turn, and without the terminal
+# as stdin, so that nothing it leaves behind can read from or reconfigure it.
+SESSION = {"start_new_session": True, "stdin": subprocess.DEVNULL}
+
+def popen(command: list[str], **kwargs):
+    process = subprocess.Popen(command, **(SESSION | kwargs))
+    process.peak = None
+    process.group_peak = 0
+    return process
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+# Resident memory of the processes in a process group in bytes
+def group_memory(pgid: int):
+    memory = 0
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(os.path.join("/proc", pid, "stat"), 'r') as stat:
+                fields = stat.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        # pgrp and rss are the 5th and 24th field of stat
+        if int(fields[2]) == pgid:
+            memory += int(fields[21]) * PAGE_SIZE
+    return memory
+
+# The resource usage that wait4 returns only holds the peak of the largest single
+# process of the group, so the group's memory is also sampled while it runs, which
+# covers processes that run side by side, such as the compilers of a parallel make.
+def sample(process: subprocess.Popen):
+    if process.returncode is None:
+        process.group_peak = max(process.group_peak, group_memory(process.pid))
+
+# Like Popen.wait, but the process is reaped with wait4, so that peak holds the
+# peak resident memory of the process group in bytes, i.e. the larger of the
+# sampled one and the largest process that the process or its descendants reaped.
+def wait(process: subprocess.Popen, timeout: float = None):
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while process.returncode is None:
+        try:
+            pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+        except ChildProcessError:
+            # reaped by someone else, its usage is lost
+            process.returncode = -1
+            break
+        if pid:
+            process.returncode = os.waitstatus_to_exitcode(status)
+            process.peak = max(usage.ru_maxrss << 10, process.group_peak)
+            break
+        if deadline is not None and time.monotonic() >= deadline:
+            raise subprocess.TimeoutExpired(process.args, timeout)
+        time.sleep(defines.GROUP_POLL_INTERVAL)
+    return process.returncode
+
+def poll(process: subprocess.Popen):
+    try:
+        return wait(process, 0)
+    except subprocess.TimeoutExpired:
+        return None
+
+# Peak resident memory of the tools that the stage running in this process has
+# run so far. Tools that run side by side, such as concurrent replays, are
+# accounted as if all of them peaked at once with the largest one.
+tools_running = 0
+most_tools_running = 0
+tool_peak = None
+tools_lock = threading.Lock()
+
+def tool_started():
+    global tools_running, most_tools_running
+    with tools_lock:
+        tools_running += 1
+        most_tools_running = max(most_tools_running, tools_running)
+
+def tool_finished(peak: int):
+    global tools_running, tool_peak
+    with tools_lock:
+        tools_running -= 1
+        if peak is not None:
+            tool_peak = max(tool_peak or 0, peak)
+
+def reset_peak():
+    global most_tools_running, tool_peak
+    with tools_lock:
+        most_tools_running = tools_running
+        tool_peak = None
+
+def stage_peak():
+    with tools_lock:
+        return None if tool_peak is None else tool_peak * max(most_tools_running, 1)
+
+def group_alive(pgid: int):
+    try:
+        os.killpg(pgid, 0)
+        return True
+    # members that changed their credentials cannot be signalled by us anyway
+    except (ProcessLookupError, PermissionError):
+        return False
+
+def signal_group(pgid: int, signum: int):
+    try:
+        os.killpg(pgid, signum)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+# Terminates the process group of a process started by popen and waits until it
+# is empty, i.e. also for the members that were orphaned when the leader exited
+# and are reaped by init. Members that outlive TERMINATION_TIMEOUT are killed.
+def kill(process: subprocess.Popen):
+    deadline = time.monotonic() + defines.TERMINATION_TIMEOUT
+    if poll(process) is None or group_alive(process.pid):
+        signal_group(process.pid, signal.SIGTERM)
+    try:
+        wait(process, defines.TERMINATION_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        pass
+    while group_alive(process.pid) and time.monotonic() < deadline:
+        time.sleep(defines.GROUP_POLL_INTERVAL)
+
+    if poll(process) is None or group_alive(process.pid):
+        signal_group(process.pid, signal.SIGKILL)
+        wait(process)
+        while group_alive(process.pid):
+            time.sleep(defines.GROUP_POLL_INTERVAL)
+
+# the tools that run has started in this process and not yet terminated
+running = set()
+
+# the wall-clock deadline of the stage that a pool worker is running, if any,
+# which every tool the stage runs is bound by
+stage_deadline = None
+
+def remaining(timeout: float = None):
+    deadlines = [deadline for deadline in [stage_deadline, None if timeout is None else time.monotonic() + timeout] if deadline is not None]
+    return min(deadlines) - time.monotonic() if deadlines else None
+
+# Like subprocess.run(..., check=True, timeout=timeout), but the process is
+# terminated as soon as stop is set, e.g. once another replay of the same bug has
+# detected it, and whatever is left of its process group once it has exited, has
+# timed out or the caller has been interrupted is terminated along with it.
+def run(command: list[str], stop: threading.Event = None, timeout: float = None, **kwargs):
+    timeout = remaining(timeout)
+    if timeout is not None and timeout <= 0:
+        raise subprocess.TimeoutExpired(command, 0)
+    process = popen(command, **kwargs)
+    running.add(process)
+    tool_started()
+    deadline = None if timeout is None else time.monotonic() + timeout
+    try:
+        while True:
+            try:
+                returncode = wait(process, defines.STOP_POLL_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                sample(process)
+                if stop is not None and stop.is_set():
+                    raise Stopped(command)
+                if deadline is not None and time.monotonic() > deadline:
+                    raise subprocess.TimeoutExpired(command, timeout)
+    finally:
+        kill(process)
+        running.discard(process)
+        tool_finished(process.peak)
+
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command)
+
+RUN_MARKER = "ENCARSIA_RUN"
+
+# Every process started by a run inherits RUN_MARKER from its environment, so
+# whatever is still around once the run has finished has leaked. Leaked processes
+# are listed with the CPU time they have used so far and killed.
+def mark_run():
+    os.environ[RUN_MARKER] = str(os.getpid())
+
+def leaked():
+    marker = f"{RUN_MARKER}={os.environ[RUN_MARKER]}".encode()
+    processes = []
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        try:
+            with open(os.path.join("/proc", pid, "environ"), 'rb') as environ:
+                if marker not in environ.read().split(b"\0"):
+                    continue
+            with open(os.path.join("/proc", pid, "stat"), 'r') as stat:
+                fields = stat.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        # fields[0] is the state, utime and stime are the 14th and 15th field of stat
+        if fields[0] != "Z":
+            cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+            processes.append((int(pid), cpu))
+    return processes
+
+def kill_leaked():
+    processes = leaked()
+    for pid, cpu in processes:
+        try:
+            with open(os.path.join("/proc", str(pid), "cmdline"), 'rb') as cmdline:
+                command = cmdline.read().replace(b"\0", b" ").decode(errors='replace').strip()
+        except OSError:
+            command = ""
+        print(f"Killing leaked process {pid} after {cpu:.1f}s of CPU time: {command}")
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    return processes
+
+YOSYS_DONE = "ENCARSIA_YOSYS_DONE"
+YOSYS_ERROR = "ENCARSIA_YOSYS_ERROR"
+
+# With shells set, Yosys scripts are run by a Yosys Tcl shell that a pool worker
+# keeps alive across its jobs instead of starting Yosys once per script. The
+# shell's stdout is line buffered so that it can be forwarded per job. A shell
+# keeps the designs that scripts save, such as the prepared reference, resident
+# for as long as its worker runs, so at most shells workers keep one. The others
+# run Yosys once per script. Workers hold a shell by locking one of the files in
+# slots, which the kernel unlocks once the worker is gone.
+class Yosys:
+    def __init__(self):
+        self.shells = 0
+        self.slots = None
+        self.slot = None
+        self.slot_pid = None
+        self.process = None
+        self.pid = None
+
+    def acquire(self):
+        # a slot inherited from the process that forked this one is not ours
+        if self.slot is not None and self.slot_pid == os.getpid():
+            return True
+        self.slot = None
+        os.makedirs(self.slots, exist_ok=True)
+        for index in range(self.shells):
+            slot = open(os.path.join(self.slots, f"{index}.lock"), 'w')
+            try:
+                fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                slot.close()
+                continue
+            self.slot = slot
+            self.slot_pid = os.getpid()
+            return True
+        return False
+
+    def start(self):
+        self.process = popen(
+            ["stdbuf", "-oL", defines.YOSYS_PATH, "-Q", "-C"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True
+        )
+        self.pid = os.getpid()
+
+    # The shell's peak resident memory is reset before every job, so that it can
+    # be accounted to the job's stage like that of any other tool.
+    def reset_peak(self):
+        try:
+            with open(f"/proc/{self.process.pid}/clear_refs", 'w') as clear_refs:
+                clear_refs.write("5")
+            return True
+        except OSError:
+            return False
+
+    def peak(self):
+        try:
+            with open(f"/proc/{self.process.pid}/status", 'r') as status:
+                for line in status:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1]) << 10
+        except OSError:
+            pass
+        return None
+
+    def run(self, script: str, cwd: str, stdout=subprocess.DEVNULL):
+        if not self.shells or not self.acquire():
+            run([defines.YOSYS_PATH, '-c', script], cwd=cwd, stdout=stdout)
+            return
+
+        # pool workers forked from a process with a running shell start their own
+        if self.process is None or self.pid != os.getpid() or poll(self.process) is not None:
+            self.start()
+
+        measured = self.reset_peak()
+        tool_started()
+        try:
+            self.job(script, cwd, stdout)
+        finally:
+            tool_finished(self.peak() if measured and self.process is not None else None)
+
+    def job(self, script: str, cwd: str, stdout):
+        self.process.stdin.write(
+            f'cd {{{cwd}}}\n'
+            f'yosys design -reset\n'
+            f'if {{[catch {{source {{{script}}}}}]}} {{yosys log {YOSYS_ERROR}}}\n'
+            f'yosys log {YOSYS_DONE}\n'
+        )
+        self.process.stdin.flush()
+
+        # a script that runs past the stage's deadline takes the shell with it
+        timeout = remaining()
+        timer = threading.Timer(max(timeout, 0), kill, (self.process,)) if timeout is not None else None
+        if timer is not None:
+            timer.start()
+
+        failed = False
+        try:
+            for line in self.process.stdout:
+                if line.strip() == YOSYS_DONE:
+                    break
+                if line.strip() == YOSYS_ERROR:
+                    failed = True
+                elif stdout != subprocess.DEVNULL:
+                    stdout.write(line)
+            else:
+                kill(self.process)
+                self.process = None
+                if timeout is not None and remaining() <= 0:
+                    raise subprocess.TimeoutExpired([defines.YOSYS_PATH, '-c', script], timeout)
+                raise subprocess.CalledProcessError(-1, [defines.YOSYS_PATH, '-c', script])
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+        if failed:
+            raise subprocess.CalledProcessError(1, [defines.YOSYS_PATH, '-c', script])
+
+yosys = Yosys()
+
+# Pool workers that are recycled are sent SIGTERM, which does not reach the
+# sessions of their tools, so they terminate their tools themselves before they
+# exit. The stage's deadline is moved to now so that no tool is started after.
+def terminate(signum, frame):
+    global stage_deadline
+    stage_deadline = 0
+    for process in list(running):
+        kill(process)
+    if yosys.process is not None and yosys.pid == os.getpid():
+        kill(yosys.process)
+    raise SystemExit(1)
@@ -0,0 +1,72 @@
+# Copyright 2024 Matej Bölcskei, ETH Zurich.
+# Licensed under the General Public License, Version 3.0, see LICENSE for details.
+# SPDX-License-Identifier: GPL-3.0-only
+
+import os
+import json
+
+import defines
+import process
+from config import Resources
+
+# kinds of stages that the host configurations hold resource estimates for,
+# any other stage is light enough to be admitted without accounting
+KINDS = {
+    "compile_dut": "compile",
+    "compile_reference": "compile",
+    "fuzz": "fuzz",
+    "campaign": "fuzz",
+    "check_mismatch": "fuzz",
+    "check_input": "fuzz",
+    "create_miter": "verify",
+    "verify": "verify",
+    "yosys_verify": "verify"
+}
+
+def available_memory():
+    with open("/proc/meminfo", 'r') as meminfo:
+        for line in meminfo:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) << 10
+    raise Exception("MemAvailable not found in /proc/meminfo!")
+
+# Runs a stage and returns its result along with the peak resident memory of the
+# tools it ran, or None if it ran none whose usage is known
+def measured(stage, *args):
+    process.reset_peak()
+    result = stage(*args)
+    return result, process.stage_peak()
+
+# The resources of a kind of stage on a host are the configured estimates until
+# the stage has been measured. Measured peaks are kept in the cache directory,
+# so that later runs admit stages by what they actually used. Compiles, whose
+# memory is spread over many short-lived compilers that sampling can miss, are
+# never admitted with less than their estimate.
+class Profiles:
+    def __init__(self, path: str):
+        self.path = path
+        self.measured = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as profiles_file:
+                self.measured = json.load(profiles_file)
+
+    def get(self, host, kind: str):
+        if host is None or kind is None:
+            return Resources(0, 0)
+        estimate = host.config.resources[kind]
+        if kind in self.measured.get(host.name, {}):
+            memory = int(self.measured[host.name][kind] * defines.MEMORY_MARGIN)
+            if kind == "compile":
+                memory = max(memory, estimate.memory)
+            return Resources(memory, estimate.cores)
+        return estimate
+
+    def learn(self, host, kind: str, memory: int):
+        if host is None or kind is None or memory is None:
+            return
+        if memory <= self.measured.get(host.name, {}).get(kind, 0):
+            return
+        self.measured.setdefault(host.name, {})[kind] = memory
+        with open(self.path + ".tmp", 'w') as profiles_file:
+            json.dump(self.measured, profiles_file, indent=4)
+        os.replace(self.path + ".tmp", self.path)
@@ -0,0 +1,29 @@
+# Copyright 2024 Matej Bölcskei, ETH Zurich.
+# Licensed under the General Public License, Version 3.0, see LICENSE for details.
+# SPDX-License-Identifier: GPL-3.0-only
+
+import os
+
+from cache import remove
+
+# Removes everything in directory except the paths in keep, which are relative to
+# directory and may point into its subdirectories.
+def prune(item):
+    directory, keep = item
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name in keep:
+            continue
+        nested = [os.path.relpath(kept, name) for kept in keep if kept.startswith(name + os.sep)]
+        if nested and os.path.isdir(path) and not os.path.islink(path):
+            prune((path, nested))
+        else:
+            remove(path)
+    return directory
+
+# Removes the given paths, relative to directory, and nothing else.
+def discard(item):
+    directory, names = item
+    for name in names:
+        remove(os.path.join(directory, name))
+    return directory
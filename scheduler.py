@@ -0,0 +1,297 @@
+# Copyright 2024 Matej Bölcskei, ETH Zurich.
+# Licensed under the General Public License, Version 3.0, see LICENSE for details.
+# SPDX-License-Identifier: GPL-3.0-only
+
+import os
+import json
+import time
+import datetime
+import traceback
+import collections
+import functools
+import multiprocessing
+import queue
+import signal
+
+from campaign import Campaign
+import defines
+import process
+import resources
+from resources import Profiles
+from config import Resources
+from affinity import Placement
+
+class Job:
+    def __init__(self, stage, args: tuple, host, profile, done):
+        self.stage = stage
+        self.args = args
+        self.host = host
+        self.profile = profile
+        self.done = done
+        self.attempts = 0
+        self.started = 0
+        self.deadline = None
+
+def initialize(placement: Placement):
+    signal.signal(signal.SIGTERM, process.terminate)
+    if placement is not None:
+        placement.pin_worker()
+
+# Runs a stage in a pool worker, with the tools it runs bound by timeout
+def execute(stage, timeout: float, *args):
+    process.stage_deadline = time.monotonic() + timeout
+    try:
+        return resources.measured(stage, *args)
+    finally:
+        process.stage_deadline = None
+
+# A pipeline is a generator that yields (stage, item) pairs. Each stage is run
+# on the pool as soon as it is yielded and its result is sent back into the
+# pipeline on completion, so every pipeline advances independently of the others.
+# Pipelines may also yield a Campaign, which is supervised by the scheduler itself
+# rather than by a pool worker, and resumes the pipeline once it has finished.
+# Stages and campaigns are only admitted while the resources profiled for them
+# fit into what the running ones leave of the memory and cores given, except
+# when nothing else is running, so that a single oversized job still runs.
+# A stage that fails or runs past its deadline is retried up to retries times
+# before its error is recorded and thrown into the pipeline, which may catch it
+# and carry on. A pipeline that does not is dropped without affecting the others.
+class Scheduler:
+    def __init__(self, processes: int, campaigns: int, early_termination: bool = False, profiles: Profiles = None, memory: int = None, cores: int = None, placement: Placement = None, retries: int = defines.STAGE_RETRIES):
+        self.processes = processes
+        self.campaigns = campaigns
+        self.early_termination = early_termination
+        self.profiles = profiles
+        self.memory = memory
+        self.cores = cores
+        self.placement = placement
+        self.retries = retries
+        self.completions = queue.SimpleQueue()
+        self.active = 0
+        self.waiting_stages = collections.deque()
+        self.running_stages = []
+        self.failures = []
+        self.waiting_campaigns = collections.deque()
+        self.running_campaigns = []
+        self.used_memory = 0
+        self.used_cores = 0
+        self.admitted = 0
+
+    def start(self, pipeline):
+        self.active += 1
+        self.advance(pipeline, None, None)
+
+    def advance(self, pipeline, result, error):
+        try:
+            if error is not None:
+                task = pipeline.throw(error)
+            else:
+                task = pipeline.send(result)
+        except StopIteration:
+            self.active -= 1
+            return
+        except Exception as pipeline_error:
+            self.active -= 1
+            if pipeline_error is not error:
+                self.record(pipeline.__name__, None, pipeline_error, 1)
+            return
+
+        if isinstance(task, Campaign):
+            self.waiting_campaigns.append((pipeline, task))
+            return
+
+        stage, item = task
+        self.submit(stage, (item,), getattr(item, "host", None), functools.partial(self.advance, pipeline))
+
+    def profile(self, stage_name: str, host):
+        if self.profiles is None:
+            return None
+        return self.profiles.get(host, resources.KINDS.get(stage_name))
+
+    def fits(self, profile):
+        if profile is None or not self.admitted:
+            return True
+        if self.memory is not None and self.used_memory + profile.memory > self.memory:
+            return False
+        if self.cores is not None and self.used_cores + profile.cores > self.cores:
+            return False
+        return True
+
+    def acquire(self, profile):
+        self.admitted += 1
+        if profile is not None:
+            self.used_memory += profile.memory
+            self.used_cores += profile.cores
+
+    def release(self, profile):
+        self.admitted -= 1
+        if profile is not None:
+            self.used_memory -= profile.memory
+            self.used_cores -= profile.cores
+
+    # done is called with the stage's result and error
+    def submit(self, stage, args: tuple, host, done):
+        self.waiting_stages.append(Job(stage, args, host, self.profile(stage.__name__, host), done))
+
+    def timeout(self, stage_name: str):
+        return defines.STAGE_TIMEOUTS.get(resources.KINDS.get(stage_name), defines.STAGE_TIMEOUT)
+
+    # results of attempts that have already been given up on are dropped
+    def completed(self, job, started, result, error):
+        if job not in self.running_stages or job.started != started:
+            return
+        self.running_stages.remove(job)
+        self.release(job.profile)
+        if error is None:
+            result, peak = result
+            if self.profiles is not None:
+                self.profiles.learn(job.host, resources.KINDS.get(job.stage.__name__), peak)
+        elif job.attempts <= self.retries and not isinstance(error, process.Stopped):
+            self.waiting_stages.append(job)
+            return
+        else:
+            self.record(job.stage.__name__, job.args[0], error, job.attempts)
+        job.done(result, error)
+
+    def create_pool(self):
+        return multiprocessing.Pool(processes=self.processes, initializer=initialize, initargs=(self.placement,))
+
+    # The worker bounds the stage's tools by the stage's timeout itself, a stage
+    # that has not returned some time after is stuck outside of them. Its worker
+    # cannot be terminated on its own, so the pool is recycled, which terminates
+    # the tools of all workers, before the stage is retried. The other stages
+    # that were running are run again without being charged an attempt.
+    def expire(self):
+        expired = [job for job in self.running_stages if time.monotonic() > job.deadline]
+        if not expired:
+            return
+        self.pool.terminate()
+        self.pool = self.create_pool()
+        for job in reversed(self.running_stages[:]):
+            if job in expired:
+                self.completed(job, job.started, None, TimeoutError(f"{job.stage.__name__} did not return in time"))
+            else:
+                self.running_stages.remove(job)
+                self.release(job.profile)
+                job.attempts -= 1
+                self.waiting_stages.appendleft(job)
+
+    # failures are recorded with the bug they belong to, or the schema
+    def record(self, stage_name: str, item, error, attempts: int):
+        failure = {
+            "stage": stage_name,
+            "directory": getattr(getattr(item, "bug", item), "directory", None),
+            "attempts": attempts,
+            "error": repr(error),
+            "traceback": "".join(traceback.format_exception(type(error), error, error.__traceback__)),
+            "time": datetime.datetime.now().strftime("%d-%m-%Y-%H-%M-%S-%f")
+        }
+        self.failures.append(failure)
+        print(f"Stage {stage_name} failed after {attempts} attempt(s): {failure['directory'] or ''} {failure['error']}")
+        if failure["directory"] is not None and os.path.isdir(failure["directory"]):
+            with open(os.path.join(failure["directory"], "failures.jsonl"), 'a') as failures_file:
+                failures_file.write(json.dumps(failure) + "\n")
+
+    # Stages are admitted in order, one that does not fit holds back the ones
+    # behind it so that heavy stages are not starved by a stream of light ones.
+    # No more stages are admitted than there are workers, so that every admitted
+    # stage starts right away and its deadline runs from its start.
+    def admit(self):
+        while self.waiting_stages and len(self.running_stages) < self.processes:
+            job = self.waiting_stages[0]
+            if not self.fits(job.profile):
+                break
+            self.waiting_stages.popleft()
+            self.acquire(job.profile)
+            timeout = self.timeout(job.stage.__name__)
+            job.attempts += 1
+            job.started += 1
+            job.deadline = time.monotonic() + timeout + defines.STAGE_GRACE
+            self.running_stages.append(job)
+            completed = functools.partial(self.completed, job, job.started)
+            self.pool.apply_async(
+                execute,
+                (job.stage, timeout) + job.args,
+                callback=lambda result, completed=completed: self.completions.put(functools.partial(completed, result, None)),
+                error_callback=lambda error, completed=completed: self.completions.put(functools.partial(completed, None, error))
+            )
+
+    def confirm(self, campaign, candidate):
+        if campaign.confirm is None:
+            campaign.detect(candidate)
+            return
+
+        campaign.confirmations += 1
+        self.submit(campaign.confirm, (campaign.item, candidate), campaign.host, functools.partial(self.confirmed, campaign, candidate))
+
+    def confirmed(self, campaign, candidate, confirmed, error):
+        campaign.confirmations -= 1
+        if confirmed and error is None:
+            campaign.detect(candidate)
+
+    def supervise(self):
+        for pipeline, campaign in self.running_campaigns[:]:
+            if self.early_termination and not campaign.finished:
+                for candidate in campaign.candidates():
+                    self.confirm(campaign, candidate)
+
+            # the campaign's process is reaped within poll, along with its peak
+            finished = campaign.poll()
+            if finished and self.profiles is not None:
+                self.profiles.learn(campaign.host, "fuzz", campaign.process.peak)
+
+            # outstanding confirmations still write into the campaign's output
+            if finished and not campaign.confirmations:
+                self.running_campaigns.remove((pipeline, campaign))
+                self.release(campaign.profile)
+                if campaign.cpus is not None:
+                    self.placement.release(campaign.cpus)
+                self.advance(pipeline, None, None)
+
+        while self.waiting_campaigns and len(self.running_campaigns) < self.campaigns:
+            pipeline, campaign = self.waiting_campaigns[0]
+            campaign.profile = self.profile("campaign", campaign.host)
+            pinned = self.placement is not None and self.placement.slots > 0
+            # pinned campaigns run on cores of their own rather than the workers'
+            if pinned and campaign.profile is not None:
+                campaign.profile = Resources(campaign.profile.memory, 0)
+            if not self.fits(campaign.profile):
+                break
+            cpus = None
+            if pinned:
+                cpus = self.placement.acquire()
+                if cpus is None:
+                    break
+            self.waiting_campaigns.popleft()
+            self.acquire(campaign.profile)
+            campaign.start(cpus)
+            self.running_campaigns.append((pipeline, campaign))
+
+        self.expire()
+        self.admit()
+
+    def wait_timeout(self):
+        timeouts = [job.deadline - time.monotonic() for job in self.running_stages]
+        if self.running_campaigns:
+            timeouts.append(defines.CAMPAIGN_POLL_INTERVAL)
+        return max(min(timeouts), 0) if timeouts else None
+
+    def run(self, pipelines):
+        self.pool = self.create_pool()
+        try:
+            for pipeline in pipelines:
+                self.start(pipeline)
+
+            self.supervise()
+            while self.active:
+                try:
+                    completion = self.completions.get(timeout=self.wait_timeout())
+                except queue.Empty:
+                    pass
+                else:
+                    completion()
+                self.supervise()
+        finally:
+            for _, campaign in self.running_campaigns:
+                campaign.stop()
+            self.pool.terminate()
@@ -0,0 +1,292 @@
+# Copyright 2024 Matej Bölcskei, ETH Zurich.
+# Licensed under the General Public License, Version 3.0, see LICENSE for details.
+# SPDX-License-Identifier: GPL-3.0-only
+
+import os
+import re
+import json
+import subprocess
+
+import defines
+import process
+import verilog
+from cache import version
+from host import Host
+from bug import Bug
+
+SELECTOR_WIDTH = 32
+
+def identifier(name: str):
+    if re.fullmatch(r'[A-Za-z_][A-Za-z0-9_$]*', name):
+        return name
+    return '\\' + name + ' '
+
+def parameter(value: int, width: int = 32):
+    return format(value, f"0{width}b")
+
+# The nets of a netlist are identified by what drives them, a cell output or a
+# module input, rather than by their bit numbers, which differ between netlists.
+def drivers(module):
+    drivers = {}
+    for name, port in module["ports"].items():
+        if port["direction"] == "input":
+            for offset, bit in enumerate(port["bits"]):
+                if isinstance(bit, int):
+                    drivers[bit] = ("port", name, offset)
+    for name, cell in module["cells"].items():
+        if "port_directions" not in cell:
+            raise Exception(f"Cell '{name}' of type {cell['type']} has no port directions!")
+        for port, bits in cell["connections"].items():
+            if cell["port_directions"][port] != "input":
+                for offset, bit in enumerate(bits):
+                    if isinstance(bit, int):
+                        drivers[bit] = (name, port, offset)
+    return drivers
+
+# A cell of a mutant is the reference's cell if it has the same name, type,
+# parameters and outputs; only its inputs may be connected differently.
+def shared(cell, reference_cell):
+    if cell["type"] != reference_cell["type"] or cell["parameters"] != reference_cell["parameters"]:
+        return False
+    if cell["connections"].keys() != reference_cell["connections"].keys():
+        return False
+    for port, bits in reference_cell["connections"].items():
+        if reference_cell["port_directions"][port] != "input":
+            if len(bits) != len(cell["connections"][port]) or not all(isinstance(bit, int) for bit in bits):
+                return False
+    return True
+
+# Merges the flattened netlists of mutants into the reference's netlist. The cells
+# of a mutant that the reference lacks are added, and every input or output that
+# a mutant connects differently is multiplexed by selector == index, so that the
+# merged module with a given selector behaves like that mutant.
+def merge(reference, mutants):
+    module = reference
+    original = {name: dict(cell["connections"]) for name, cell in module["cells"].items()}
+    original_ports = {name: list(port["bits"]) for name, port in module["ports"].items()}
+    reference_drivers = {driver: bit for bit, driver in drivers(module).items()}
+
+    bits = [bit for port in module["ports"].values() for bit in port["bits"]]
+    bits += [bit for cell in module["cells"].values() for connection in cell["connections"].values() for bit in connection]
+    bits += [bit for netname in module["netnames"].values() for bit in netname["bits"]]
+    next_bit = max([bit for bit in bits if isinstance(bit, int)] + [1]) + 1
+
+    def fresh(width):
+        nonlocal next_bit
+        next_bit += width
+        return list(range(next_bit - width, next_bit))
+
+    selector = fresh(SELECTOR_WIDTH)
+    module["ports"]["encarsia_selector"] = {"direction": "input", "bits": selector}
+    module["netnames"]["encarsia_selector"] = {"hide_name": 0, "bits": selector, "attributes": {}}
+
+    def add_cell(name, type, parameters, port_directions, connections):
+        module["cells"][name] = {
+            "hide_name": 1,
+            "type": type,
+            "parameters": parameters,
+            "attributes": {},
+            "port_directions": port_directions,
+            "connections": connections
+        }
+
+    for index, (mutant_name, mutant) in enumerate(mutants):
+        if mutant["ports"].keys() != module["ports"].keys() - {"encarsia_selector"}:
+            raise Exception(f"The interface of {mutant_name} differs from the reference!")
+
+        mutant_drivers = drivers(mutant)
+        common = {
+            name for name, cell in mutant["cells"].items()
+            if name in original and shared(cell, reference["cells"][name])
+        }
+        mapped = {}
+        def bit(mutant_bit):
+            if not isinstance(mutant_bit, int):
+                return mutant_bit
+            if mutant_bit not in mapped:
+                driver = mutant_drivers.get(mutant_bit)
+                if driver is not None and (driver[0] == "port" or driver[0] in common) and driver in reference_drivers:
+                    mapped[mutant_bit] = reference_drivers[driver]
+                else:
+                    mapped[mutant_bit] = fresh(1)[0]
+            return mapped[mutant_bit]
+
+        selected = None
+        def guard(current, value):
+            nonlocal selected
+            if selected is None:
+                selected = fresh(1)
+                add_cell(
+                    f"$encarsia$select${index}",
+                    "$eq",
+                    {"A_SIGNED": parameter(0), "B_SIGNED": parameter(0), "A_WIDTH": parameter(SELECTOR_WIDTH), "B_WIDTH": parameter(SELECTOR_WIDTH), "Y_WIDTH": parameter(1)},
+                    {"A": "input", "B": "input", "Y": "output"},
+                    {"A": selector, "B": list(reversed(parameter(index, SELECTOR_WIDTH))), "Y": selected}
+                )
+            output = fresh(len(value))
+            add_cell(
+                f"$encarsia$guard${index}${len(module['cells'])}",
+                "$mux",
+                {"WIDTH": parameter(len(value))},
+                {"A": "input", "B": "input", "S": "input", "Y": "output"},
+                {"A": current, "B": value, "S": selected, "Y": output}
+            )
+            return output
+
+        for name, cell in mutant["cells"].items():
+            if name in common:
+                for port, connection in cell["connections"].items():
+                    if cell["port_directions"][port] != "input":
+                        continue
+                    value = [bit(mutant_bit) for mutant_bit in connection]
+                    if value != original[name][port]:
+                        module["cells"][name]["connections"][port] = guard(module["cells"][name]["connections"][port], value)
+            else:
+                module["cells"][f"{name}$bug{index}"] = dict(
+                    cell,
+                    connections={port: [bit(mutant_bit) for mutant_bit in connection] for port, connection in cell["connections"].items()}
+                )
+
+        for name, port in mutant["ports"].items():
+            if port["direction"] == "output":
+                value = [bit(mutant_bit) for mutant_bit in port["bits"]]
+                if value != original_ports[name]:
+                    module["ports"][name]["bits"] = guard(module["ports"][name]["bits"], value)
+                    if name in module["netnames"]:
+                        module["netnames"][name] = dict(module["netnames"][name], bits=module["ports"][name]["bits"])
+
+        # names of the mutant's own nets, which carry attributes such as init
+        for name, netname in mutant["netnames"].items():
+            if all(isinstance(mutant_bit, int) and mapped.get(mutant_bit, 0) >= selector[0] for mutant_bit in netname["bits"]):
+                module["netnames"][f"{name}$bug{index}"] = dict(netname, bits=[mapped[mutant_bit] for mutant_bit in netname["bits"]])
+
+    return module
+
+# A mutant schema is a single core that carries the mutations of many bugs. The
+# flattened netlist of each bug is merged into the reference's, with every net
+# that the bug drives differently selected by selector == <selector>, and the
+# core is instantiated by a wrapper with the host module's interface that sets
+# the selector from a plusarg. A single simulator build, which evaluates one
+# core per cycle, can then fuzz any of the bugs.
+class Schema:
+    def __init__(self, host: Host, bugs: list[Bug]):
+        self.host = host
+        self.bugs = sorted(bugs, key=lambda bug: bug.directory)
+        self.directory = os.path.join(host.directory, "schema")
+        os.makedirs(self.directory, exist_ok=True)
+
+    def selector(self, bug: Bug):
+        return [schema_bug.directory for schema_bug in self.bugs].index(bug.directory)
+
+    def create_netlist(self, rtlil: str, netlist: str):
+        netlist_script = (
+            f'read_rtlil {os.path.relpath(rtlil, self.directory)}; '
+            f'hierarchy -top {self.host.config.host_module}; '
+            f'memory_collect; '
+            f'select {self.host.config.host_module}; '
+            f'write_json -selected {os.path.basename(netlist)}'
+        )
+        self.host.cache.run(
+            "create_schema_netlist",
+            [netlist],
+            lambda: process.run(
+                [defines.YOSYS_PATH, '-p', netlist_script],
+                cwd=self.directory,
+                stdout=subprocess.DEVNULL
+            ),
+            files=[rtlil],
+            texts=[netlist_script, version(defines.YOSYS_PATH, "-V")]
+        )
+        return netlist
+
+    def create_netlists(self):
+        # every bug is merged into the same reference, which only decides what is shared
+        self.reference = self.create_netlist(os.path.join(self.bugs[0].directory, "reference.rtlil"), os.path.join(self.directory, "reference.json"))
+        self.netlists = [
+            self.create_netlist(os.path.join(bug.directory, "host.rtlil"), os.path.join(self.directory, f"{selector}.json"))
+            for selector, bug in enumerate(self.bugs)
+        ]
+        return self
+
+    def create_core(self):
+        self.netlist = os.path.join(self.directory, "core.json")
+
+        def produce():
+            with open(self.reference, 'r') as reference_file:
+                reference = json.load(reference_file)["modules"][self.host.config.host_module]
+            def mutants():
+                for netlist in self.netlists:
+                    with open(netlist, 'r') as netlist_file:
+                        yield netlist, json.load(netlist_file)["modules"][self.host.config.host_module]
+            core = merge(reference, mutants())
+            with open(self.netlist, 'w') as netlist_file:
+                json.dump({"modules": {f"{self.host.config.host_module}_schema": core}}, netlist_file)
+
+        self.host.cache.run(
+            "create_schema_core",
+            [self.netlist],
+            produce,
+            files=[self.reference] + self.netlists
+        )
+
+        self.core = os.path.join(self.directory, "core.v")
+        core_script = (
+            f'read_json core.json; '
+            f'write_verilog -noattr core.v'
+        )
+        self.host.cache.run(
+            "create_schema_core_verilog",
+            [self.core],
+            lambda: process.run(
+                [defines.YOSYS_PATH, '-p', core_script],
+                cwd=self.directory,
+                stdout=subprocess.DEVNULL
+            ),
+            files=[self.netlist],
+            texts=[core_script, version(defines.YOSYS_PATH, "-V")]
+        )
+
+        return self
+
+    def create_wrapper(self):
+        with open(self.reference, 'r') as reference_file:
+            ports = json.load(reference_file)["modules"][self.host.config.host_module]["ports"]
+
+        wrapper = [f'module {self.host.config.host_module}(' + ', '.join(identifier(name) for name in ports) + ');']
+        for name, port in ports.items():
+            if port["direction"] == "inout":
+                raise Exception(f"Port '{name}' of {self.host.config.host_module} is bidirectional!")
+            width = f'[{len(port["bits"])-1}:0] ' if len(port["bits"]) > 1 else ''
+            wrapper.append(f'  {port["direction"]} {width}{identifier(name)};')
+
+        wrapper.append('  integer selector;')
+        wrapper.append(f'  initial if (!$value$plusargs("{defines.SCHEMA_PLUSARG}=%d", selector)) selector = 0;')
+
+        connections = [f'.{identifier(name)}({identifier(name)})' for name in ports]
+        connections.append('.encarsia_selector(selector)')
+        wrapper.append(f'  {self.host.config.host_module}_schema core(' + ', '.join(connections) + ');')
+        wrapper.append('endmodule')
+
+        return '\n'.join(wrapper) + '\n'
+
+    def create_dut(self):
+        self.create_netlists()
+        self.create_core()
+
+        self.schema_path = os.path.join(self.directory, "schema.v")
+        with open(self.schema_path + ".tmp", 'w') as schema_file:
+            schema_file.write(self.create_wrapper())
+            with open(self.core, 'r') as core_file:
+                schema_file.write(core_file.read())
+        os.replace(self.schema_path + ".tmp", self.schema_path)
+
+        self.dut_path = os.path.join(self.directory, "dut.v")
+
+        self.host.cache.run(
+            "create_dut",
+            [self.dut_path],
+            lambda: verilog.include(self.host.cache.stored(self.host.cascade_receptor), self.schema_path, self.dut_path),
+            files=[self.host.cascade_receptor, self.schema_path]
+        )
+
+        return self
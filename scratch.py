@@ -0,0 +1,141 @@
+# Copyright 2024 Matej Bölcskei, ETH Zurich.
+# Licensed under the General Public License, Version 3.0, see LICENSE for details.
+# SPDX-License-Identifier: GPL-3.0-only
+
+import os
+import json
+import fcntl
+import shutil
+import tempfile
+import contextlib
+
+import defines
+from cache import remove
+
+def size(path: str):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except FileNotFoundError:
+                pass
+    return total
+
+# Directories that see many small writes while a stage runs, i.e. build trees and
+# simulation outputs, can be placed in a scratch directory such as a tmpfs and
+# symlinked from the run directory. Every scratch directory reserves the size
+# that directories of its kind reached before, or SCRATCH_ESTIMATE for a kind
+# not seen yet, against the budget, and a directory is only placed on scratch if
+# its reservation fits and more than SCRATCH_RESERVE bytes are free. Otherwise
+# the run directory is used as is. Reservations are files next to the scratch
+# directories, so that all worker processes see them, and are released together
+# with their directory.
+class Scratch:
+    def __init__(self, directory: str = None, budget: int = None, profile: str = None):
+        self.directory = directory
+        self.profile = profile
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+            if budget is None:
+                budget = shutil.disk_usage(self.directory).total - defines.SCRATCH_RESERVE
+        self.budget = budget
+
+    @contextlib.contextmanager
+    def locked(self):
+        with open(os.path.join(self.directory, ".lock"), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def available(self):
+        return self.directory is not None and shutil.disk_usage(self.directory).free > defines.SCRATCH_RESERVE
+
+    def sizes(self):
+        if self.profile is None or not os.path.exists(self.profile):
+            return {}
+        with open(self.profile, 'r') as profile_file:
+            return json.load(profile_file)
+
+    def reserved(self):
+        reserved = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            # reservations whose directory is gone have been left by a run that died
+            if name.endswith(".reserved") and os.path.isdir(path[:-len(".reserved")]):
+                with open(path, 'r') as reservation_file:
+                    reserved += json.load(reservation_file)["size"]
+        return reserved
+
+    def mkdtemp(self, prefix: str, kind: str):
+        if not self.available():
+            return None
+        with self.locked():
+            sizes = self.sizes()
+            expected = int(sizes[kind] * defines.SCRATCH_MARGIN) if kind in sizes else defines.SCRATCH_ESTIMATE
+            if self.reserved() + expected > self.budget:
+                return None
+            directory = tempfile.mkdtemp(dir=self.directory, prefix=prefix)
+            with open(directory + ".reserved", 'w') as reservation_file:
+                json.dump({"kind": kind, "size": expected}, reservation_file)
+        return directory
+
+    # Removes directory and, if it is on scratch, releases its reservation after
+    # learning the size that directories of its kind reach.
+    def release(self, directory: str):
+        reservation = directory + ".reserved"
+        if self.directory is None or not os.path.exists(reservation):
+            remove(directory)
+            return
+        used = size(directory)
+        remove(directory)
+        with self.locked():
+            with open(reservation, 'r') as reservation_file:
+                kind = json.load(reservation_file)["kind"]
+            sizes = self.sizes()
+            if self.profile is not None and used > sizes.get(kind, 0):
+                sizes[kind] = used
+                with open(self.profile + ".tmp", 'w') as profile_file:
+                    json.dump(sizes, profile_file, indent=4)
+                os.replace(self.profile + ".tmp", self.profile)
+            os.remove(reservation)
+
+    def stage(self, path: str):
+        # the scratch of a previous run is gone
+        if os.path.islink(path) and not os.path.exists(path):
+            os.remove(path)
+        if os.path.lexists(path):
+            return
+        directory = self.mkdtemp(os.path.basename(path)+"-", os.path.basename(path))
+        if directory is not None:
+            os.symlink(directory, path)
+
+    # removes path, and its scratch if it is staged
+    def clear(self, path: str):
+        if self.staged(path):
+            self.release(os.path.realpath(path))
+        remove(path)
+
+    def staged(self, path: str):
+        return self.directory is not None and os.path.islink(path) and os.path.realpath(path).startswith(os.path.realpath(self.directory) + os.sep)
+
+    # Replaces the staged directories of directory by the paths in keep, which are
+    # relative to directory, and frees their scratch.
+    def unstage(self, item):
+        directory, keep = item
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if not self.staged(path):
+                continue
+            target = os.path.realpath(path)
+            os.remove(path)
+            for kept in keep:
+                if kept != name and not kept.startswith(name + os.sep):
+                    continue
+                source = os.path.normpath(os.path.join(target, os.path.relpath(kept, name)))
+                if os.path.isdir(source):
+                    shutil.copytree(source, os.path.join(directory, kept), dirs_exist_ok=True)
+                elif os.path.exists(source):
+                    os.makedirs(os.path.dirname(os.path.join(directory, kept)), exist_ok=True)
+                    shutil.copy2(source, os.path.join(directory, kept))
+            self.release(target)
+        return directory
@@ -0,0 +1,56 @@
+# Copyright 2024 Matej Bölcskei, ETH Zurich.
+# Licensed under the General Public License, Version 3.0, see LICENSE for details.
+# SPDX-License-Identifier: GPL-3.0-only
+
+import os
+import re
+import shutil
+
+# Concatenates sources into destination like "\n".join would, but one line at a
+# time and without the modules named in excluded, i.e. without everything from
+# "module <name>" up to the next "endmodule".
+def filter_modules(sources: list[str], destination: str, excluded: list[str]):
+    start = re.compile(r'\bmodule\s+(?:' + '|'.join(re.escape(module) for module in excluded) + r')\b')
+    end = re.compile(r'\bendmodule\b')
+    skipping = False
+    with open(destination, 'w') as destination_file:
+        for index, source in enumerate(sources):
+            if index and not skipping:
+                destination_file.write("\n")
+            with open(source, 'r') as source_file:
+                if not excluded:
+                    shutil.copyfileobj(source_file, destination_file)
+                    continue
+
+                pending = ""
+                for line in source_file:
+                    line = pending + line
+                    pending = ""
+                    # the module name may follow on one of the next lines
+                    if not skipping and re.search(r'\bmodule\s*$', line):
+                        pending = line
+                        continue
+
+                    position = 0
+                    while position < len(line):
+                        match = (end if skipping else start).search(line, position)
+                        if match is None:
+                            if not skipping:
+                                destination_file.write(line[position:])
+                            break
+                        if not skipping:
+                            destination_file.write(line[position:match.start()])
+                        position = match.end()
+                        skipping = not skipping
+                destination_file.write(pending)
+
+# Writes destination as an include of shared followed by the contents of source.
+# The tools take a single source file, and the include lets all bugs of a host
+# read the same receptor instead of a copy of it each. shared should be a path
+# that is the same across runs, such as that of a stored cache file, since it is
+# part of destination and hence of the keys of the builds that read it.
+def include(shared: str, source: str, destination: str):
+    with open(destination, 'w') as destination_file:
+        destination_file.write(f'`include "{os.path.abspath(shared)}"\n')
+        with open(source, 'r') as source_file:
+            shutil.copyfileobj(source_file, destination_file)